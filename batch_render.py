@@ -0,0 +1,257 @@
+"""
+    Headless batch renderer.
+
+    Renders a list of jobs (scene seed and size, camera path, resolution,
+    frame count) on a pool of worker processes. Each worker owns one
+    offscreen context and keeps its linked programs and loaded meshes
+    from job to job. Frames are written as png files to
+    output/<job name>/, with a manifest.json of per job timings.
+
+    eg. python batch_render.py jobs.json --output renders --workers 4
+
+    jobs.json is a list of objects, every key optional:
+    {"name": "a", "seed": 1, "cubes": 500, "lights": 20, "width": 640,
+     "height": 360, "frames": 60, "lighting": "tiled", "gbuffer": "full",
+     "animation": "cpu", "capture": "output",
+     "camera": {"orbit": 20} | {"replay": "input.rec"}
+             | {"keyframes": [[x, y, z, pitch, yaw, roll], ...]}}
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+# sets up EGL and release mode error checking, before OpenGL is imported
+from benchmark import OffscreenContext, orbit_camera
+from OpenGL.GL import *
+
+from deferred_shading import (
+    Scene, Engine, ProgramCache, MeshCache, InputRecording, steer_camera,
+    summarize,
+    WIDTH, HEIGHT, CUBES_NUMBER, LIGHTS_NUMBER, LIGHTING_MODE,
+    GBUFFER_LAYOUT, CUBE_ANIMATION, CAPTURE_SOURCE
+)
+
+
+# frames of a job that does not say, a replay defaults to its length
+BATCH_FRAMES = 60
+
+
+# what a worker keeps between jobs
+_context = None
+_programCache = None
+_meshCache = None
+
+
+def job_defaults(job, index):
+    """
+        job with every missing key filled in.
+    """
+    return {
+        "name": f"job_{index:04d}",
+        "seed": 0,
+        "cubes": CUBES_NUMBER,
+        "lights": LIGHTS_NUMBER,
+        "width": WIDTH,
+        "height": HEIGHT,
+        "frames": None,
+        "lighting": LIGHTING_MODE,
+        "gbuffer": GBUFFER_LAYOUT,
+        "animation": CUBE_ANIMATION,
+        "capture": CAPTURE_SOURCE,
+        "camera": {"orbit": 20},
+        **job
+    }
+
+
+def camera_path(camera, frames):
+    """
+        function(scene, frame) placing the scene's camera for each frame,
+        the scene seed it needs (None: the job's own) and the number of
+        frames to render.
+    """
+
+    if "replay" in camera:
+        recording = InputRecording.load(camera["replay"])
+
+        def place(scene, frame):
+            steer_camera(scene.camera, *recording.frames[frame])
+        return place, recording.seed, \
+            len(recording) if frames is None else min(frames, len(recording))
+
+    if frames is None:
+        frames = BATCH_FRAMES
+
+    if "keyframes" in camera:
+        keyframes = np.asarray(camera["keyframes"], dtype=np.float32)
+        times = np.linspace(0, 1, len(keyframes))
+
+        def place(scene, frame):
+            t = frame / max(frames - 1, 1)
+            pose = [np.interp(t, times, column) for column in keyframes.T]
+            scene.camera.position[:] = pose[0:3]
+            scene.camera.eulers[:] = pose[3:6]
+        return place, None, frames
+
+    radius = camera.get("orbit", 20)
+
+    def place(scene, frame):
+        orbit_camera(scene.camera, frame, frames, radius)
+    return place, None, frames
+
+
+def start_worker(width, height, workers):
+    """
+        Pool initializer: one context big enough for every job.
+    """
+
+    global _context, _programCache, _meshCache
+    # llvmpipe starts a thread per core in every process otherwise
+    os.environ.setdefault(
+        "LP_NUM_THREADS", str(max(1, os.cpu_count() // workers)))
+    _context = OffscreenContext(width, height)
+    _programCache = ProgramCache()
+    _meshCache = MeshCache()
+
+
+def render_job(job, output):
+    """
+        Render one job into output/<name>/, returns its manifest entry,
+        times in seconds. A job that fails gets an entry with its error
+        and no timings, the rest of the batch carries on.
+    """
+
+    engine = None
+    try:
+        start = time.perf_counter()
+        place, seed, frames = camera_path(job["camera"], job["frames"])
+        scene = Scene(cubeCount=job["cubes"], lightCount=job["lights"],
+                      seed=job["seed"] if seed is None else seed)
+        engine = Engine(scene, job["width"], job["height"], job["lighting"],
+                        statsHistory=max(frames, 1),
+                        gBufferLayout=job["gbuffer"],
+                        cubeAnimation=job["animation"],
+                        programCache=_programCache, meshCache=_meshCache)
+        engine.assets.finish()
+        directory = os.path.join(output, job["name"])
+        os.makedirs(directory, exist_ok=True)
+        if job["capture"] is not None:
+            engine.start_capture(
+                os.path.join(directory, "frame_{frame:04d}.png"),
+                job["capture"])
+        setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for frame in range(frames):
+            place(scene, frame)
+            if job["animation"] == "gpu":
+                scene.advance()
+            else:
+                scene.update()
+            engine.draw(scene)
+            _context.swap()
+        glFinish()
+        render = time.perf_counter() - start
+
+        # waits for the writer to save the last frames
+        start = time.perf_counter()
+        if job["capture"] is not None:
+            engine.stop_capture()
+        write = time.perf_counter() - start
+
+        engine.timer.flush()
+        _, _, gpu = engine.stats.rows()
+        entry = {
+            "name": job["name"],
+            "worker": os.getpid(),
+            "frames": frames,
+            "setup": setup,
+            "render": render,
+            "write": write,
+            "fps": frames / render if render > 0 else None,
+            "gpu_ms": summarize(np.nansum(gpu, axis=1))
+        }
+    except Exception as error:
+        entry = {
+            "name": job["name"],
+            "worker": os.getpid(),
+            "error": f"{type(error).__name__}: {error}"
+        }
+    finally:
+        if engine is not None:
+            # a failed capture raises its error again on the way out
+            with contextlib.suppress(Exception):
+                engine.quit()
+
+    return entry
+
+
+def run_batch(jobs, output, workers=None):
+    """
+        Render every job on workers processes (the number of cores by
+        default), returns the manifest also written to
+        output/manifest.json, failed jobs included.
+    """
+
+    jobs = [job_defaults(job, i) for i, job in enumerate(jobs)]
+    names = [job["name"] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("job names must be unique")
+    workers = min(workers or os.cpu_count(), max(len(jobs), 1))
+    os.makedirs(output, exist_ok=True)
+
+    # the biggest jobs go first, so no worker is left with one at the end
+    order = sorted(range(len(jobs)), reverse=True, key=lambda i: (
+        jobs[i]["width"] * jobs[i]["height"]
+        * (jobs[i]["frames"] or BATCH_FRAMES)))
+    width = max((job["width"] for job in jobs), default=1)
+    height = max((job["height"] for job in jobs), default=1)
+
+    start = time.perf_counter()
+    # forked workers would inherit the parent's GL and loader threads
+    with multiprocessing.get_context("spawn").Pool(
+            workers, start_worker, (width, height, workers)) as pool:
+        results = pool.starmap(render_job,
+                               [(jobs[i], output) for i in order],
+                               chunksize=1)
+    elapsed = time.perf_counter() - start
+
+    entries = [None] * len(jobs)
+    for i, result in zip(order, results):
+        entries[i] = result
+    manifest = {
+        "workers": workers,
+        "jobs": entries,
+        "frames": sum(entry.get("frames", 0) for entry in entries),
+        "failed": sum("error" in entry for entry in entries),
+        "seconds": elapsed
+    }
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("jobs", help="json list of jobs")
+    parser.add_argument("--output", default="renders")
+    parser.add_argument("--workers", type=int,
+                        help="processes, the number of cores by default")
+    args = parser.parse_args()
+
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+    manifest = run_batch(jobs, args.output, args.workers)
+    print(json.dumps({key: manifest[key] for key in
+                      ("workers", "frames", "failed", "seconds")}, indent=4))
+    if manifest["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
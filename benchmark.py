@@ -0,0 +1,285 @@
+"""
+    Headless renderer benchmark.
+
+    Renders a seeded scene offscreen (EGL pbuffer, works with Mesa's
+    software llvmpipe driver) along a scripted camera orbit, then prints
+    CPU and GPU frame time percentiles, overall and per pass, as JSON.
+
+    eg. python benchmark.py --frames 300 --cubes 5000 --lights 100
+
+    --replay follows the camera path and scene seed of an input recording
+    (see RECORD_FILE) instead, one recorded frame per measured frame.
+"""
+import os
+# must be set before OpenGL is imported anywhere
+os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+# release mode, no glGetError after every call (PYOPENGL_ERROR_CHECKING=1)
+os.environ.setdefault("PYOPENGL_ERROR_CHECKING", "0")
+# keeps stdout clean for the json report
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import ctypes
+import json
+import time
+from OpenGL.raw.EGL import _errors
+# PyOpenGL 3.1 leaves this undefined with error checking off, which
+# breaks importing the EGL functions
+if not hasattr(_errors, "_error_checker"):
+    _errors._error_checker = None
+from OpenGL import EGL
+from OpenGL.GL import *
+import numpy as np
+
+from deferred_shading import (
+    Scene, Engine, InputRecording, summarize, steer_camera,
+    WIDTH, HEIGHT, CUBES_NUMBER, LIGHTS_NUMBER, LIGHTING_MODE, GBUFFER_LAYOUT,
+    FRAME_BUDGET_MS, CUBE_ANIMATION, CUBE_MESHES, CUBE_MATERIALS,
+    CAPTURE_SOURCE
+)
+
+
+class OffscreenContext:
+    """
+        OpenGL 3.3 core context rendering into a pbuffer of the given size,
+        which then acts as the default framebuffer.
+    """
+
+    def __init__(self, width, height):
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        EGL.eglInitialize(self.display, ctypes.pointer(major),
+                          ctypes.pointer(minor))
+
+        config_attributes = (
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_ALPHA_SIZE, 8,
+            EGL.EGL_DEPTH_SIZE, 24,
+            EGL.EGL_STENCIL_SIZE, 8,
+            EGL.EGL_NONE
+        )
+        config = EGL.EGLConfig()
+        config_count = EGL.EGLint()
+        EGL.eglChooseConfig(
+            self.display,
+            (EGL.EGLint * len(config_attributes))(*config_attributes),
+            ctypes.pointer(config), 1, ctypes.pointer(config_count)
+        )
+        if config_count.value == 0:
+            raise RuntimeError("no EGL config supports offscreen OpenGL")
+
+        surface_attributes = (
+            EGL.EGL_WIDTH, width,
+            EGL.EGL_HEIGHT, height,
+            EGL.EGL_NONE
+        )
+        self.surface = EGL.eglCreatePbufferSurface(
+            self.display, config,
+            (EGL.EGLint * len(surface_attributes))(*surface_attributes)
+        )
+
+        context_attributes = (
+            EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+            EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+            EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE
+        )
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(
+            self.display, config, EGL.EGL_NO_CONTEXT,
+            (EGL.EGLint * len(context_attributes))(*context_attributes)
+        )
+        EGL.eglMakeCurrent(self.display, self.surface,
+                           self.surface, self.context)
+
+    def swap(self):
+        EGL.eglSwapBuffers(self.display, self.surface)
+
+    def destroy(self):
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE,
+                           EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglTerminate(self.display)
+
+
+def orbit_camera(camera, frame, frames, radius=20):
+    """
+        Scripted camera: one full orbit around the origin over the run,
+        always facing the centre of the scene.
+    """
+    angle = 2 * np.pi * frame / frames
+    camera.position[:] = (-radius * np.cos(angle), -radius * np.sin(angle), 0)
+    camera.eulers[:] = (0, np.degrees(angle) % 360, 0)
+
+
+def run_benchmark(frames=300, warmup=30, cubes=CUBES_NUMBER,
+                  lights=LIGHTS_NUMBER, width=WIDTH, height=HEIGHT,
+                  seed=0, lightingMode=LIGHTING_MODE,
+                  gBufferLayout=GBUFFER_LAYOUT, frameBudget=FRAME_BUDGET_MS,
+                  cubeAnimation=CUBE_ANIMATION, meshes=CUBE_MESHES,
+                  materials=CUBE_MATERIALS, capture=None,
+                  captureSource=CAPTURE_SOURCE, replay=None):
+    """
+        Render warmup + frames frames and return the timing report,
+        times are in milliseconds. capture is where the measured frames
+        are written to, see Engine.start_capture. replay is an input
+        recording file, which sets the seed and number of frames.
+    """
+
+    recording = None
+    if replay is not None:
+        recording = InputRecording.load(replay)
+        seed = recording.seed
+        frames = len(recording)
+
+    context = OffscreenContext(width, height)
+    scene = Scene(cubeCount=cubes, lightCount=lights, seed=seed,
+                  meshes=meshes, materials=materials)
+    # the engine's per pass timings keep exactly the measured frames
+    engine = Engine(scene, width, height, lightingMode,
+                    statsHistory=frames, gBufferLayout=gBufferLayout,
+                    frameBudget=frameBudget, cubeAnimation=cubeAnimation)
+    # measure the scene as it is meant to look, not its placeholders
+    engine.assets.finish()
+    cpuTimes = []
+    renderScales = []
+    glCalls = []
+
+    start = time.perf_counter()
+    for frame in range(warmup + frames):
+        if frame == warmup:
+            glFinish()
+            if capture is not None:
+                engine.start_capture(capture, captureSource)
+            start = time.perf_counter()
+        if recording is None:
+            orbit_camera(scene.camera, frame, warmup + frames)
+        elif frame >= warmup:
+            steer_camera(scene.camera, *recording.frames[frame - warmup])
+
+        frameStart = time.perf_counter()
+        # a replay starts from the scene as it was recorded, warmup frames
+        # only draw it
+        if recording is not None and frame < warmup:
+            pass
+        elif cubeAnimation == "gpu":
+            scene.advance()
+        else:
+            scene.update()
+        engine.draw(scene)
+        if frame >= warmup:
+            cpuTimes.append(1000 * (time.perf_counter() - frameStart))
+            renderScales.append(engine.renderScale)
+            glCalls.append(engine.gl.frameCalls)
+        context.swap()
+    glFinish()
+    elapsed = time.perf_counter() - start
+    if capture is not None:
+        engine.stop_capture()
+
+    engine.timer.flush()
+    _, _, gpu = engine.stats.rows()
+    gpuTimes = np.nansum(gpu, axis=1)
+    passes = engine.stats.summary()
+    del passes["frame"]
+    renderer = glGetString(GL_RENDERER).decode()
+    batches = len(engine.renderQueue.batches)
+
+    engine.quit()
+    context.destroy()
+
+    return {
+        "renderer": renderer,
+        "frames": frames,
+        "cubes": cubes,
+        "lights": lights,
+        "width": width,
+        "height": height,
+        "seed": seed,
+        "replay": replay,
+        "lightingMode": lightingMode,
+        "gBufferLayout": gBufferLayout,
+        "frameBudget": frameBudget,
+        "cubeAnimation": cubeAnimation,
+        "meshes": len(meshes),
+        "materials": len(materials),
+        "batches": batches,
+        "capture": captureSource if capture is not None else None,
+        "renderScale": summarize(renderScales),
+        "fps": frames / elapsed,
+        "cpu_ms": summarize(cpuTimes),
+        "gpu_ms": summarize(gpuTimes),
+        "passes": passes,
+        # per frame, through the engine's state cache
+        "gl_calls": {
+            "issued": summarize([issued for issued, _ in glCalls]),
+            "skipped": summarize([skipped for _, skipped in glCalls])
+        }
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--cubes", type=int, default=CUBES_NUMBER)
+    parser.add_argument("--lights", type=int, default=LIGHTS_NUMBER)
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--height", type=int, default=HEIGHT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lighting", default=LIGHTING_MODE,
+                        choices=("full_screen", "tiled", "light_volumes"))
+    parser.add_argument("--gbuffer", default=GBUFFER_LAYOUT,
+                        choices=("full", "compact"))
+    parser.add_argument("--budget", type=float, default=FRAME_BUDGET_MS,
+                        help="gpu ms per frame for dynamic resolution")
+    parser.add_argument("--animation", default=CUBE_ANIMATION,
+                        choices=("cpu", "gpu"))
+    parser.add_argument("--meshes", nargs="+", default=CUBE_MESHES,
+                        help="obj files the cubes are drawn with")
+    parser.add_argument("--materials", type=int,
+                        help="number of random colored materials")
+    parser.add_argument("--capture",
+                        help="png pattern with {frame}, or raw frames file")
+    parser.add_argument("--capture-source", default=CAPTURE_SOURCE,
+                        choices=("output", "lighting", "depth", "position",
+                                 "diffuseSpecular", "normal"))
+    parser.add_argument("--replay", help="input recording to follow")
+    parser.add_argument("--output", help="write the report here, not stdout")
+    args = parser.parse_args()
+
+    materials = CUBE_MATERIALS
+    if args.materials is not None:
+        rng = np.random.default_rng(args.seed)
+        materials = [(tuple(rng.uniform(0.2, 1, 3)), 1.0)
+                     for _ in range(args.materials)]
+
+    report = run_benchmark(
+        frames=args.frames, warmup=args.warmup,
+        cubes=args.cubes, lights=args.lights,
+        width=args.width, height=args.height,
+        seed=args.seed, lightingMode=args.lighting,
+        gBufferLayout=args.gbuffer, frameBudget=args.budget,
+        cubeAnimation=args.animation, meshes=args.meshes,
+        materials=materials, capture=args.capture,
+        captureSource=args.capture_source, replay=args.replay
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
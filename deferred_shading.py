@@ -1,28 +1,677 @@
 import pygame as pg
 from OpenGL.GL import *
 from OpenGL.GL.shaders import compileProgram, compileShader
+import OpenGL.raw.GL.VERSION.GL_1_0 as rawGL10
+import OpenGL.raw.GL.VERSION.GL_3_3 as rawGL
 import numpy as np
 import pyrr
-import random
+import re
+import os
+import sys
+import json
+import hashlib
+import csv
+import time
+import contextlib
+import threading
+import concurrent.futures
+import functools
+import queue
+import struct
+import zlib
 
 
 WIDTH = 1920
 HEIGHT = 1080
 LIGHTS_NUMBER = 10
 CUBES_NUMBER = 200
+LIGHT_RADIUS = 10
+# "full_screen": every pixel evaluates every light
+# "tiled": lights are binned into TILE_SIZE screen tiles on the cpu first
+# "light_volumes": a proxy sphere is drawn for each light, stencil bounded
+# to the surfaces inside it, two draw calls per light
+LIGHTING_MODE = "full_screen"
+TILE_SIZE = 16
+# "full": world position, diffuse/specular and normal targets
+# "compact": diffuse/specular and an octahedral RG16 normal, position is
+# rebuilt from the depth buffer, about half the bytes per pixel
+GBUFFER_LAYOUT = "full"
+# cubes are frustum culled through a uniform grid of GRID_CELL_SIZE cells
+# once there are at least GRID_MIN_INSTANCES, below that testing every
+# cube directly is cheaper
+GRID_CELL_SIZE = 16
+GRID_MIN_INSTANCES = 2048
+MESH_CACHE_DIR = "cache/meshes"
+PROGRAM_CACHE_DIR = "cache/programs"
+# per pass timings: frames kept, whether the overlay starts visible (F3
+# toggles it) and where App writes them on exit (.csv or .json, None: off)
+STATS_HISTORY = 600
+SHOW_STATS = False
+STATS_FILE = None
+# dynamic resolution: GPU milliseconds per frame to stay within by scaling
+# the geometry and lighting passes down to MIN_RENDER_SCALE of the output
+# size (None: always render at full size)
+FRAME_BUDGET_MS = None
+MIN_RENDER_SCALE = 0.5
+# scene updates per second on a worker thread, rendering interpolates
+# between them (None: one update per rendered frame on the main thread)
+SIMULATION_RATE = None
+# "cpu": cube matrices are built on the cpu and streamed every frame
+# "gpu": position, eulers at time 0 and euler velocity are uploaded once and
+# g_vertex rotates the cubes from Scene.time, all cubes are drawn unculled
+CUBE_ANIMATION = "cpu"
+# meshes and (diffuse rgb or image file, specular) materials the cubes are
+# drawn with, each cube is given one of each at random
+CUBE_MESHES = ("models/cube.obj",)
+CUBE_MATERIALS = (((1.0, 1.0, 1.0), 1.0),)
+# camera distances past which cubes switch to their next coarser level of
+# detail, a switch waits until the distance is LOD_HYSTERESIS (a fraction
+# of the threshold) past it, so cubes sitting near one do not pop
+LOD_DISTANCES = (15.0, 30.0)
+LOD_HYSTERESIS = 0.1
+# meshes without their own name_lod1.obj, name_lod2.obj, ... files get
+# levels simplified by vertex clustering, this many cells across
+LOD_GRID_CELLS = (24, 8)
+# meshes and textures are decoded by ASSET_WORKERS threads and uploaded
+# ASSET_UPLOAD_BUDGET bytes per frame, PLACEHOLDER_MESH stands in for a
+# mesh until then, image materials are MATERIAL_TEXTURE_SIZE squared.
+# A single image material makes every diffuse layer that size, with mip
+# levels about 4/3 * 4 * size^2 bytes per material (1.4 MB at 512)
+ASSET_WORKERS = 4
+ASSET_UPLOAD_BUDGET = 4 << 20
+PLACEHOLDER_MESH = "models/cube.obj"
+MATERIAL_TEXTURE_SIZE = 512
+# frames App captures: None (off), a png filename pattern with a {frame}
+# field, or a file (or named pipe) raw RGBA frames are appended to, top
+# row first. CAPTURE_SOURCE is "output", "lighting", "depth" or a G-buffer
+# target: "position" (full layout), "diffuseSpecular" or "normal". Pixels
+# are read back CAPTURE_LATENCY frames after they were drawn
+CAPTURE_FILE = None
+CAPTURE_SOURCE = "output"
+CAPTURE_LATENCY = 3
+# png frames are compressed on CAPTURE_ENCODERS threads at zlib level
+# CAPTURE_PNG_LEVEL, a 1080p frame takes one about 35 ms at level 1 (and
+# twice that at 6, for files half the size)
+CAPTURE_ENCODERS = 4
+CAPTURE_PNG_LEVEL = 1
+# scene seed of App (None: a new one every run). RECORD_FILE logs it with
+# the camera input and frame time of every frame, REPLAY_FILE plays such
+# a log back instead of live input, as fast as frames render, then App
+# prints the frame timings. Both update the scene once per frame
+RECORD_FILE = None
+REPLAY_FILE = None
+SCENE_SEED = None
+# keys that move the camera: (key, direction, axis) for Camera.move, only
+# the first one held counts
+CAMERA_KEYS = (
+    (pg.K_w, 0, "x"),
+    (pg.K_a, 90, "x"),
+    (pg.K_s, 180, "y"),
+    (pg.K_d, -90, "y"),
+    (pg.K_LSHIFT, 90, "z"),
+    (pg.K_LCTRL, -90, "z")
+)
+
+
+def create_model_transforms(positions, eulers, out):
+    """
+        Batched equivalent of
+        identity * create_from_eulers(radians(eulers)) * create_from_translation(position)
+        for every row of the (N,3) positions/eulers arrays, written into the
+        (N,4,4) out array.
+    """
+    radians = np.radians(eulers, dtype=np.float32)
+    sR, sP, sY = np.sin(radians).T
+    cR, cP, cY = np.cos(radians).T
+
+    out[:, 0, 0] = cY * cP
+    out[:, 0, 1] = -cY * sP * cR + sY * sR
+    out[:, 0, 2] = cY * sP * sR + sY * cR
+    out[:, 1, 0] = sP
+    out[:, 1, 1] = cP * cR
+    out[:, 1, 2] = -cP * sR
+    out[:, 2, 0] = -sY * cP
+    out[:, 2, 1] = sY * sP * cR + cY * sR
+    out[:, 2, 2] = -sY * sP * sR + cY * cR
+    out[:, 0:3, 3] = 0
+    out[:, 3, 0:3] = positions
+    out[:, 3, 3] = 1
+
+    return out
+
+
+def pack_lights(lights, out):
+    """
+        Pack the light arrays into the (N,2,4) layout read by the lighting
+        pass: texel 0 is position + strength, texel 1 is color.
+    """
+    out[:, 0, 0:3] = lights.positions
+    out[:, 0, 3] = lights.strengths
+    out[:, 1, 0:3] = lights.colors
+    out[:, 1, 3] = lights.radii
+
+    return out
+
+
+def bin_lights(positions, radii, view, projection, width, height, tileSize):
+    """
+        Assign every light to the screen tiles covered by its sphere of
+        influence. Returns (tiles, indices), tiles holds the (offset, count)
+        of each tile's run inside indices, tile rows go bottom to top.
+        Bounds are conservative, so a tile never misses a light that
+        reaches one of its pixels.
+    """
+    tilesX = -(-width // tileSize)
+    tilesY = -(-height // tileSize)
+    near = projection[3, 2] / (projection[2, 2] - 1)
+    far = projection[3, 2] / (projection[2, 2] + 1)
+
+    center = positions @ view[:3, :3] + view[3, :3]
+    depth = -center[:, 2]
+    visible = (depth + radii > near) & (depth - radii < far)
+    # spheres crossing the near plane can cover any part of the screen
+    inside = depth - radii <= near
+    closest = np.where(inside, 1, depth - radii)
+    furthest = depth + radii
+
+    first = []
+    last = []
+    for axis, scale, size, count in (
+        (0, projection[0, 0], width, tilesX),
+        (1, projection[1, 1], height, tilesY)
+    ):
+        low = center[:, axis] - radii
+        high = center[:, axis] + radii
+        low = np.where(low > 0, low / furthest, low / closest) * scale
+        high = np.where(high > 0, high / closest, high / furthest) * scale
+        low = np.where(inside, -1, low)
+        high = np.where(inside, 1, high)
+        visible &= (high >= -1) & (low <= 1)
+        first.append(np.clip(
+            (low * 0.5 + 0.5) * size // tileSize, 0, count - 1).astype(np.int64))
+        last.append(np.clip(
+            (high * 0.5 + 0.5) * size // tileSize, 0, count - 1).astype(np.int64))
+
+    lightIndices = np.flatnonzero(visible)
+    x0, y0 = first[0][lightIndices], first[1][lightIndices]
+    w = last[0][lightIndices] - x0 + 1
+    h = last[1][lightIndices] - y0 + 1
+
+    # one (tile, light) pair per covered tile, grouped by tile
+    counts = w * h
+    pairLights = np.repeat(np.arange(len(lightIndices)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairTiles = (y0[pairLights] + local // w[pairLights]) * tilesX \
+        + x0[pairLights] + local % w[pairLights]
+    order = np.argsort(pairTiles, kind="stable")
+
+    tiles = np.zeros((tilesX * tilesY, 2), dtype=np.int32)
+    tiles[:, 1] = np.bincount(pairTiles, minlength=tilesX * tilesY)
+    tiles[1:, 0] = np.cumsum(tiles[:-1, 1])
+    indices = lightIndices[pairLights[order]].astype(np.int32)
+
+    return tiles, indices
+
+
+def frustum_planes(view, projection):
+    """
+        World space planes of the view frustum as a (6,4) array of
+        (normal, distance) rows with unit normals pointing inwards,
+        so a point p is inside when p . normal + distance >= 0 for all.
+    """
+    # transposed, so each row maps a point to one clip space coordinate
+    clip = (view @ projection).T
+    planes = np.array((
+        clip[3] + clip[0], clip[3] - clip[0],
+        clip[3] + clip[1], clip[3] - clip[1],
+        clip[3] + clip[2], clip[3] - clip[2]
+    ))
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def spheres_in_frustum(centers, radii, planes):
+    """
+        Boolean mask of the (N,3) spheres that are at least partly
+        inside the frustum planes, radii is a scalar or (N,) array.
+    """
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    return np.all(distances >= -np.reshape(radii, (-1, 1)), axis=1)
+
+
+def query_result(query):
+    """
+        64 bit nanosecond result of a timer query, PyOpenGL's wrapper has
+        no array type for GLuint64 so this goes through the raw binding.
+    """
+    result = ctypes.c_uint64()
+    rawGL.glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+    return result.value
+
+
+def summarize(samples):
+    """
+        mean and percentiles of a list of timings, NaN entries are skipped.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    samples = samples[~np.isnan(samples)]
+    if len(samples) == 0:
+        samples = np.zeros(1)
+    return {
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max())
+    }
+
+
+def encode_png(pixels, level=6):
+    """
+        png file contents of (height, width, 4) uint8 RGBA pixels, top row
+        first. zlib lets other threads run while it compresses, unlike
+        pygame's png writer.
+    """
+
+    height, width = pixels.shape[:2]
+    # every row starts with its filter type, 0: none
+    rows = np.zeros((height, 1 + 4 * width), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data)))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height,
+                                         8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), level))
+            + chunk(b"IEND", b""))
+
+
+def normalize(vectors):
+    """
+        Row-wise normalization of an (N,3) array, zero rows stay zero.
+    """
+    lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(lengths > 0, lengths, 1)
+
+
+def select_lods(distances, current, thresholds, hysteresis, levelCounts):
+    """
+        Level of detail of each instance: level i once its distance is
+        past thresholds[i - 1]. current is kept until the distance is
+        hysteresis (a fraction) beyond the threshold in between, levels
+        are capped at the instance's levelCounts - 1.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    lowest = np.searchsorted(thresholds * (1 + hysteresis), distances)
+    highest = np.searchsorted(thresholds * (1 - hysteresis), distances)
+    return np.minimum(np.clip(current, lowest, highest), levelCounts - 1)
+
+
+def simplify_mesh(vertices, indices, cells):
+    """
+        Vertex clustering: vertices falling in the same cell of a grid
+        cells across the mesh's largest extent merge into one with their
+        averaged attributes, triangles that collapse are dropped.
+        Takes and returns (vertices, indices) like ObjMesh.loadMesh.
+    """
+
+    positions = vertices[:, 0:3]
+    low = positions.min(axis=0)
+    extent = float((positions.max(axis=0) - low).max())
+    cellSize = extent / cells if extent > 0 else 1
+    cell = np.minimum((positions - low) // cellSize, cells - 1)
+    cell = cell.astype(np.int64)
+    keys = (cell[:, 0] * cells + cell[:, 1]) * cells + cell[:, 2]
+    _, clusters = np.unique(keys, return_inverse=True)
+    clusters = clusters.reshape(-1)
+
+    uses = np.bincount(clusters)
+    merged = np.zeros((len(uses), vertices.shape[1]), dtype=np.float32)
+    for column in range(vertices.shape[1]):
+        merged[:, column] = np.bincount(
+            clusters, weights=vertices[:, column]) / uses
+    # normal, tangent and bitangent
+    for column in (5, 8, 11):
+        merged[:, column:column + 3] = normalize(merged[:, column:column + 3])
+
+    triangles = clusters[indices].reshape(-1, 3)
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1])
+                          & (triangles[:, 1] != triangles[:, 2])
+                          & (triangles[:, 2] != triangles[:, 0])]
+    # only the clusters still referenced stay
+    used, triangles = np.unique(triangles, return_inverse=True)
+
+    return merged[used], triangles.reshape(-1).astype(np.uint32)
+
+
+def obj_lines(text, flag):
+    """
+        Data part of every line of an obj file starting with flag,
+        as a list of strings.
+    """
+    # a literal "\nflag" prefix lets the regex engine skip ahead quickly
+    return re.findall(rf"\n{flag}[ \t]+([^\n]*)", "\n" + text)
+
+
+def obj_line_starts(text, flag):
+    """
+        Character offsets of every line of an obj file starting with flag.
+    """
+    return np.array([
+        match.start()
+        for match in re.finditer(rf"\n{flag}[ \t]", "\n" + text)
+    ], dtype=np.int64)
+
+
+def parse_floats(lines, width):
+    """
+        Parse the data part of obj lines into an (N,width) float array,
+        extra components (eg. the w of a vertex) are dropped.
+    """
+    values = np.fromstring("\n".join(lines), dtype=np.float64, sep=" ")
+    if len(values) == width * len(lines):
+        return values.reshape(-1, width)
+    # mixed component counts, fall back to one line at a time
+    return np.array([line.split()[:width] for line in lines],
+                    dtype=np.float64).reshape(-1, width)
+
+
+def parse_faces(faces):
+    """
+        Parse the data part of obj face lines. Returns the number of
+        corners of each face and an (N,3) int64 array of the raw
+        (v, vt, vn) indices of every corner, 0 where not given.
+    """
+    text = "\n".join(faces)
+    if not text.strip():
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+
+    # corners per face: tokens starting on each line
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    blank = np.isin(data, np.frombuffer(b" \t\r\n", dtype=np.uint8))
+    tokenStarts = ~blank
+    tokenStarts[1:] &= blank[:-1]
+    lineEnds = np.append(np.flatnonzero(data == ord("\n")), len(data) - 1)
+    faceSizes = np.diff(np.cumsum(tokenStarts)[lineEnds], prepend=0)
+
+    # v, v/vt, v//vn or v/vt/vn, normally the same for a whole file
+    width = text.split(None, 1)[0].replace("//", "/0/").count("/") + 1
+    values = np.fromstring(
+        text.replace("//", "/0/").replace("/", " "), dtype=np.int64, sep=" ")
+    corners = np.zeros((faceSizes.sum(), 3), dtype=np.int64)
+    if len(values) == width * len(corners):
+        corners[:, :width] = values.reshape(-1, width)
+        return faceSizes, corners
+
+    for i, token in enumerate(text.split()):
+        for j, index in enumerate(token.split("/")):
+            if index:
+                corners[i, j] = int(index)
+    return faceSizes, corners
+
+
+def steer_camera(camera, mouseX, mouseY, keys, frameTime):
+    """
+        One frame of input: turn by the mouse's offset from the window
+        centre, then move along the first held key of CAMERA_KEYS (bit i
+        of keys), both scaled by the frame time in milliseconds.
+    """
+
+    camera.increment_direction(frameTime * 0.00005 * mouseX,
+                               frameTime * 0.00005 * mouseY)
+    for i, (_, direction, axis) in enumerate(CAMERA_KEYS):
+        if keys >> i & 1:
+            camera.move(direction, 0.02 * frameTime, axis)
+            return
+
+
+class CubeArray:
+    """
+        Structure-of-arrays storage for every cube in the scene, each
+        attribute is a contiguous (N,3) float32 array, apart from the
+        (N,) int32 indices of the scene mesh and material it is drawn with.
+    """
+
+    def __init__(self, positions, eulers, eulerVelocities,
+                 meshIds=None, materialIds=None):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float32)
+        self.eulers = np.ascontiguousarray(eulers, dtype=np.float32)
+        self.eulerVelocities = np.ascontiguousarray(
+            eulerVelocities, dtype=np.float32)
+        self.meshIds = np.zeros(len(self.positions), dtype=np.int32)
+        if meshIds is not None:
+            self.meshIds[:] = meshIds
+        self.materialIds = np.zeros(len(self.positions), dtype=np.int32)
+        if materialIds is not None:
+            self.materialIds[:] = materialIds
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        return Cube(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Cube(self, i)
 
 
 class Cube:
-    def __init__(self, position, eulers, eulerVelocity):
-        self.position = np.array(position, dtype=np.float32)
-        self.eulers = np.array(eulers, dtype=np.float32)
-        self.eulerVelocity = np.array(eulerVelocity, dtype=np.float32)
+    """
+        View of a single cube, reads and writes go straight
+        through to the owning CubeArray.
+    """
+
+    def __init__(self, cubes, index):
+        self.cubes = cubes
+        self.index = index
+
+    @property
+    def position(self):
+        return self.cubes.positions[self.index]
+
+    @position.setter
+    def position(self, value):
+        self.cubes.positions[self.index] = value
+
+    @property
+    def eulers(self):
+        return self.cubes.eulers[self.index]
+
+    @eulers.setter
+    def eulers(self, value):
+        self.cubes.eulers[self.index] = value
+
+    @property
+    def eulerVelocity(self):
+        return self.cubes.eulerVelocities[self.index]
+
+    @eulerVelocity.setter
+    def eulerVelocity(self, value):
+        self.cubes.eulerVelocities[self.index] = value
+
+    @property
+    def mesh(self):
+        return self.cubes.meshIds[self.index]
+
+    @mesh.setter
+    def mesh(self, value):
+        self.cubes.meshIds[self.index] = value
+
+    @property
+    def material(self):
+        return self.cubes.materialIds[self.index]
+
+    @material.setter
+    def material(self, value):
+        self.cubes.materialIds[self.index] = value
+
+
+class LightArray:
+    """
+        Structure-of-arrays storage for every light in the scene,
+        each attribute is a contiguous (N,3) float32 array.
+    """
+
+    def __init__(self, positions, colors, strengths=None, radii=None):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float32)
+        self.colors = np.ascontiguousarray(colors, dtype=np.float32)
+        if strengths is None:
+            strengths = np.ones(len(self.positions))
+        self.strengths = np.ascontiguousarray(strengths, dtype=np.float32)
+        if radii is None:
+            radii = np.full(len(self.positions), LIGHT_RADIUS)
+        self.radii = np.ascontiguousarray(radii, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        return Light(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Light(self, i)
 
 
 class Light:
-    def __init__(self, position, color):
-        self.position = np.array(position, dtype=np.float32)
-        self.color = np.array(color, dtype=np.float32)
+    """
+        View of a single light, reads and writes go straight
+        through to the owning LightArray.
+    """
+
+    def __init__(self, lights, index):
+        self.lights = lights
+        self.index = index
+
+    @property
+    def position(self):
+        return self.lights.positions[self.index]
+
+    @position.setter
+    def position(self, value):
+        self.lights.positions[self.index] = value
+
+    @property
+    def color(self):
+        return self.lights.colors[self.index]
+
+    @color.setter
+    def color(self, value):
+        self.lights.colors[self.index] = value
+
+    @property
+    def strength(self):
+        return self.lights.strengths[self.index]
+
+    @strength.setter
+    def strength(self, value):
+        self.lights.strengths[self.index] = value
+
+    @property
+    def radius(self):
+        return self.lights.radii[self.index]
+
+    @radius.setter
+    def radius(self, value):
+        self.lights.radii[self.index] = value
+
+
+class UniformGrid:
+    """
+        Instance positions binned into cubic cells for frustum culling.
+        Whole cells are tested against the frustum first, only instances
+        in cells crossing a plane are tested one by one.
+        Every instance is bounded by a sphere of the same radius.
+    """
+
+    def __init__(self, positions, cellSize, radius):
+
+        self.cellSize = cellSize
+        self.radius = radius
+        self.build(positions)
+
+    def build(self, positions):
+
+        self.positions = np.array(positions, dtype=np.float32)
+        # cell coordinates -> cell id, ids are never reused
+        self.cellIds = {}
+        self.cells = self.assign(self.positions)
+        self.sort()
+
+    def assign(self, positions):
+        """
+            Cell id of each position, new cells get the next free id.
+        """
+
+        coords = np.floor(positions / self.cellSize).astype(np.int64)
+        unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+        ids = np.array([
+            self.cellIds.setdefault(tuple(cell), len(self.cellIds))
+            for cell in unique.tolist()
+        ], dtype=np.int64)
+        return ids[inverse.ravel()]
+
+    def sort(self):
+
+        # instances grouped by cell, each cell is a run of self.order
+        self.order = np.argsort(self.cells, kind="stable")
+        self.counts = np.bincount(self.cells, minlength=len(self.cellIds))
+        self.starts = np.cumsum(self.counts) - self.counts
+        coords = np.array(list(self.cellIds), dtype=np.float32).reshape(-1, 3)
+        self.centers = (coords + 0.5) * self.cellSize
+
+    def update(self, positions):
+        """
+            Rebin the instances that moved since the last update,
+            returns how many did.
+        """
+
+        if len(positions) != len(self.positions):
+            self.build(positions)
+            return len(positions)
+
+        moved = np.flatnonzero(np.any(positions != self.positions, axis=1))
+        if len(moved) == 0:
+            return 0
+        self.positions[moved] = positions[moved]
+
+        cells = self.assign(self.positions[moved])
+        changed = cells != self.cells[moved]
+        # the grouping only changes when something crossed into a new cell
+        if changed.any():
+            self.cells[moved[changed]] = cells[changed]
+            self.sort()
+
+        return len(moved)
+
+    def members(self, cells):
+
+        counts = self.counts[cells]
+        local = np.arange(counts.sum()) \
+            - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.order[np.repeat(self.starts[cells], counts) + local]
+
+    def query(self, planes):
+        """
+            Ascending indices of the instances whose bounding sphere
+            is at least partly inside the frustum planes.
+        """
+
+        distances = self.centers @ planes[:, :3].T + planes[:, 3]
+        # how far the cell box reaches along each plane normal
+        reach = 0.5 * self.cellSize * np.abs(planes[:, :3]).sum(axis=1)
+        outside = np.any(distances < -(reach + self.radius), axis=1)
+        inside = np.all(distances >= reach, axis=1)
+
+        accepted = self.members(np.flatnonzero(inside))
+        candidates = self.members(np.flatnonzero(~inside & ~outside))
+        candidates = candidates[spheres_in_frustum(
+            self.positions[candidates], self.radius, planes)]
+
+        return np.sort(np.concatenate((accepted, candidates)))
 
 
 class Camera:
@@ -92,39 +741,191 @@ class Camera:
 
 
 class Scene:
-    def __init__(self):
-        self.cubes = [
-            Cube(
-                position=[random.uniform(a=-10, b=10) for x in range(3)],
-                eulers=[random.uniform(a=0, b=360) for x in range(3)],
-                eulerVelocity=[random.uniform(a=-0.1, b=0.1) for x in range(3)]
-            )
-
-            for i in range(CUBES_NUMBER)
-        ]
-
-        self.lights = [
-            Light(
-                position=[random.uniform(a=-10, b=10) for x in range(3)],
-                color=[random.uniform(a=0.1, b=1) for x in range(3)]
-            )
+    def __init__(self, cubeCount=CUBES_NUMBER, lightCount=LIGHTS_NUMBER,
+                 seed=None, meshes=CUBE_MESHES, materials=CUBE_MATERIALS):
+        # a fixed seed always generates the same scene
+        rng = np.random.default_rng(seed)
+
+        self.cubes = CubeArray(
+            positions=rng.uniform(
+                low=-10, high=10, size=(cubeCount, 3)),
+            eulers=rng.uniform(
+                low=0, high=360, size=(cubeCount, 3)),
+            eulerVelocities=rng.uniform(
+                low=-0.1, high=0.1, size=(cubeCount, 3))
+        )
 
-            for i in range(LIGHTS_NUMBER)
-        ]
+        self.lights = LightArray(
+            positions=rng.uniform(
+                low=-10, high=10, size=(lightCount, 3)),
+            colors=rng.uniform(
+                low=0.1, high=1, size=(lightCount, 3))
+        )
 
         self.camera = Camera(
             position=[-20, 0, 0],
             eulers=[0, 0, 0]
         )
 
+        # obj filenames and (diffuse rgb, specular) colors, drawn last so
+        # the rest of a seeded scene does not depend on how many there are
+        self.meshes = tuple(meshes)
+        self.materials = tuple(materials)
+        if len(self.meshes) > 1:
+            self.cubes.meshIds[:] = rng.integers(
+                len(self.meshes), size=cubeCount)
+        if len(self.materials) > 1:
+            self.cubes.materialIds[:] = rng.integers(
+                len(self.materials), size=cubeCount)
+
+        # number of updates so far
+        self.time = 0
+
     def update(self):
 
-        for cube in self.cubes:
-            cube.eulers = np.mod(
-                cube.eulers + cube.eulerVelocity,
-                [360, 360, 360],
-                dtype=np.float32
+        eulers = self.cubes.eulers
+        np.add(eulers, self.cubes.eulerVelocities, out=eulers)
+        np.mod(eulers, 360, out=eulers)
+        self.time += 1
+
+    def advance(self):
+        """
+            Move the clock without touching the cubes, for when their
+            rotation is evaluated on the gpu from the time instead.
+        """
+        self.time += 1
+
+
+class Simulation:
+    """
+        Runs Scene.update at a fixed rate on a worker thread and builds
+        the cube model matrices of every tick into one of three snapshot
+        buffers: the two latest ticks, which the renderer blends between,
+        and the one being written. The renderer shows the scene one tick
+        in the past, so there is always a newer tick to blend towards.
+        The state after n ticks does not depend on how fast frames render.
+    """
+
+    def __init__(self, scene, rate=SIMULATION_RATE):
+
+        self.scene = scene
+        self.timestep = 1 / rate
+        self.tick = 0
+        self.startTime = None
+
+        self.snapshots = np.zeros(
+            (3, len(scene.cubes), 4, 4), dtype=np.float32)
+        for snapshot in self.snapshots[:2]:
+            create_model_transforms(
+                scene.cubes.positions, scene.cubes.eulers, out=snapshot)
+        self.previous, self.latest, self.free = 0, 1, 2
+
+        # guards the snapshot roles and the tick count
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+
+        self.startTime = time.perf_counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+
+        while self.running:
+            wait = self.startTime + (self.tick + 1) * self.timestep \
+                - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+
+            # the free snapshot is never read, no lock needed to fill it
+            self.scene.update()
+            create_model_transforms(
+                self.scene.cubes.positions, self.scene.cubes.eulers,
+                out=self.snapshots[self.free]
             )
+            with self.lock:
+                self.previous, self.latest, self.free = \
+                    self.latest, self.free, self.previous
+                self.tick += 1
+
+    def interpolate(self, indices, out):
+        """
+            Model matrices of the cubes at indices, blended between the
+            two latest ticks for the current time, written into out.
+            Matrices are blended linearly, close enough to the rotation
+            in between for the small angles covered by one tick.
+        """
+
+        with self.lock:
+            alpha = (time.perf_counter() - self.startTime) / self.timestep \
+                - self.tick
+            np.take(self.snapshots[self.previous], indices, axis=0, out=out)
+            latest = self.snapshots[self.latest][indices]
+
+        alpha = min(max(alpha, 0.0), 1.0)
+        latest -= out
+        latest *= alpha
+        out += latest
+        return out
+
+
+class InputRecording:
+    """
+        Scene seed and per frame camera input, enough to render the same
+        frames again. Stored as a small header and 14 bytes per frame:
+        mouse offset, held CAMERA_KEYS bits and frame time.
+    """
+
+    MAGIC = b"DSIN"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHq")
+    FRAME = np.dtype([("mouseX", "<i2"), ("mouseY", "<i2"),
+                      ("keys", "<u2"), ("frameTime", "<f8")])
+
+    def __init__(self, seed, frames=()):
+
+        self.seed = seed
+        # (mouseX, mouseY, keys, frameTime) per frame
+        self.frames = list(frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def record(self, mouseX, mouseY, keys, frameTime):
+        self.frames.append((mouseX, mouseY, keys, frameTime))
+
+    def save(self, filename):
+
+        with open(filename, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.seed))
+            f.write(np.array(self.frames, dtype=self.FRAME).tobytes())
+
+    @classmethod
+    def load(cls, filename):
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        magic, version, seed = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{filename} is not an input recording "
+                             f"of version {cls.VERSION}")
+        frames = np.frombuffer(data, dtype=cls.FRAME,
+                               offset=cls.HEADER.size)
+        return cls(seed, frames.tolist())
 
 
 class App:
@@ -135,6 +936,16 @@ class App:
         self.numFrames = 0
         self.frameTime = 0
         self.lightCount = 0
+        self.recording = None
+        self.replay = None
+        seed = SCENE_SEED
+        if REPLAY_FILE is not None:
+            self.replay = InputRecording.load(REPLAY_FILE)
+            seed = self.replay.seed
+        elif seed is None:
+            seed = int(np.random.default_rng().integers(2**63))
+        if RECORD_FILE is not None:
+            self.recording = InputRecording(seed)
         # initialise pygame
         pg.init()
         pg.display.gl_set_attribute(pg.GL_CONTEXT_MAJOR_VERSION, 3)
@@ -145,55 +956,74 @@ class App:
         pg.mouse.set_pos((WIDTH/2, HEIGHT/2))
         pg.mouse.set_visible(False)
 
-        self.scene = Scene()
+        self.scene = Scene(seed=seed)
 
-        self.engine = Engine(self.scene)
+        # a replay keeps the timings of all its frames
+        self.engine = Engine(self.scene, statsHistory=STATS_HISTORY
+                             if self.replay is None
+                             else max(1, len(self.replay)))
+        if CAPTURE_FILE is not None:
+            self.engine.start_capture(CAPTURE_FILE, CAPTURE_SOURCE)
+
+        # a simulation thread's ticks follow real time, not frames
+        self.simulation = None
+        if SIMULATION_RATE is not None and CUBE_ANIMATION == "cpu" \
+                and self.recording is None and self.replay is None:
+            self.simulation = Simulation(self.scene, SIMULATION_RATE)
+            self.simulation.start()
 
         self.mainLoop()
 
     def mainLoop(self):
         running = True
+        frames = iter(self.replay) if self.replay is not None else None
         while (running):
             # check events
             for event in pg.event.get():
                 if (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
                     running = False
-            self.handleMouse()
-            self.handleKeys()
-            # update objects
-            self.scene.update()
+                if (event.type == pg.KEYDOWN and event.key == pg.K_F3):
+                    self.engine.showStats = not self.engine.showStats
+            if frames is not None:
+                frame = next(frames, None)
+                if frame is None:
+                    break
+                mouseX, mouseY, keys, self.frameTime = frame
+            else:
+                mouseX, mouseY = self.handleMouse()
+                keys = self.handleKeys()
+                if self.recording is not None:
+                    self.recording.record(mouseX, mouseY, keys,
+                                          self.frameTime)
+            steer_camera(self.scene.camera, mouseX, mouseY, keys,
+                         self.frameTime)
+            # update objects, unless the simulation thread or gpu does
+            if CUBE_ANIMATION == "gpu":
+                self.scene.advance()
+            elif self.simulation is None:
+                self.scene.update()
             # refresh screen
-            self.engine.draw(self.scene)
-            self.calculateFrameTime()
+            self.engine.draw(self.scene, self.simulation)
+            pg.display.flip()
+            if frames is None:
+                self.calculateFrameTime()
         self.quit()
 
     def handleKeys(self):
-        keys = pg.key.get_pressed()
-        if keys[pg.K_w]:
-            self.scene.camera.move(0, 0.02*self.frameTime, "x")
-            return
-        if keys[pg.K_a]:
-            self.scene.camera.move(90, 0.02*self.frameTime, "x")
-            return
-        if keys[pg.K_s]:
-            self.scene.camera.move(180, 0.02*self.frameTime, "y")
-            return
-        if keys[pg.K_d]:
-            self.scene.camera.move(-90, 0.02*self.frameTime, "y")
-            return
-        if keys[pg.K_LSHIFT]:
-            self.scene.camera.move(90, 0.02*self.frameTime, "z")
-            return
-        if keys[pg.K_LCTRL]:
-            self.scene.camera.move(-90, 0.02*self.frameTime, "z")
-            return
+        """
+            CAMERA_KEYS held down, as bits.
+        """
+        pressed = pg.key.get_pressed()
+        return sum(1 << i for i, (key, _, _) in enumerate(CAMERA_KEYS)
+                   if pressed[key])
 
     def handleMouse(self):
+        """
+            Mouse offset from the window centre, which it is put back to.
+        """
         (x, y) = pg.mouse.get_pos()
-        theta_increment = self.frameTime * 0.00005 * (WIDTH/2 - x)
-        phi_increment = self.frameTime * 0.00005 * (HEIGHT/2 - y)
-        self.scene.camera.increment_direction(theta_increment, phi_increment)
-        pg.mouse.set_pos((WIDTH/2, HEIGHT/2))
+        pg.mouse.set_pos((WIDTH // 2, HEIGHT // 2))
+        return WIDTH // 2 - x, HEIGHT // 2 - y
 
     def calculateFrameTime(self):
         currentTime = pg.time.get_ticks()
@@ -207,32 +1037,86 @@ class App:
 
     def quit(self):
 
+        if self.recording is not None:
+            self.recording.save(RECORD_FILE)
+        if STATS_FILE is not None or self.replay is not None:
+            self.engine.timer.flush()
+        if STATS_FILE is not None:
+            self.engine.stats.dump(STATS_FILE)
+        if self.replay is not None:
+            print(json.dumps(self.engine.stats.summary(), indent=4))
+        if self.simulation is not None:
+            self.simulation.stop()
         self.engine.quit()
         pg.quit()
 
 
 class Engine:
-    def __init__(self, scene):
+    def __init__(self, scene, width=WIDTH, height=HEIGHT,
+                 lightingMode=LIGHTING_MODE, statsHistory=STATS_HISTORY,
+                 gBufferLayout=GBUFFER_LAYOUT, frameBudget=FRAME_BUDGET_MS,
+                 cubeAnimation=CUBE_ANIMATION, programCache=None,
+                 meshCache=None):
+        self.width = width
+        self.height = height
+        self.cubeAnimation = cubeAnimation
+        self.gBufferLayout = gBufferLayout
+        gBufferDefines = ("COMPACT_GBUFFER",) \
+            if gBufferLayout == "compact" else ()
+        # every per frame state change goes through here
+        self.gl = GLState()
+
         # initialise opengl
         glClearColor(0.1, 0.1, 0.1, 1)
         glEnable(GL_DEPTH_TEST)
         glEnable(GL_CULL_FACE)
         glCullFace(GL_BACK)
 
+        # caches passed in are shared with later engines on the same
+        # context, so their programs outlive this one
+        self.ownsProgramCache = programCache is None
+        self.programCache = ProgramCache() if programCache is None \
+            else programCache
+        self.meshCache = MeshCache() if meshCache is None else meshCache
+        # uniform name -> location, per program
+        self.uniformLocations = {}
+
         self.shaderGPass = self.createShader(
             "shaders/g_vertex.txt",
-            "shaders/g_fragment.txt"
+            "shaders/g_fragment.txt",
+            defines=gBufferDefines
+            + (("GPU_ANIMATION",) if cubeAnimation == "gpu" else ())
         )
 
+        self.lightingMode = lightingMode
         self.shaderLPass = self.createShader(
             "shaders/l_vertex.txt",
-            "shaders/l_fragment.txt"
+            "shaders/l_fragment.txt",
+            defines=gBufferDefines
+            + (("TILED_LIGHTING",) if lightingMode == "tiled" else ())
         )
         self.shaderColored = self.createShader(
             "shaders/simple_3d_vertex.txt",
             "shaders/simple_3d_fragment.txt"
         )
 
+        if lightingMode == "light_volumes":
+            self.shaderLVolume = self.createShader(
+                "shaders/l_volume_vertex.txt",
+                "shaders/l_fragment.txt",
+                defines=gBufferDefines + ("LIGHT_VOLUMES",)
+            )
+            # only fills the stencil buffer, color writes are masked
+            self.shaderLStencil = self.createShader(
+                "shaders/l_volume_vertex.txt",
+                "shaders/stencil_fragment.txt"
+            )
+
+        self.shaderOverlay = self.createShader(
+            "shaders/l_vertex.txt",
+            "shaders/overlay_fragment.txt"
+        )
+
         self.get_uniform_locations()
 
         self.set_initial_uniform_values()
@@ -241,181 +1125,309 @@ class Engine:
 
         self.create_framebuffer()
 
-    def createShader(self, vertexFilepath, fragmentFilepath):
+        self.timer = PassTimer(
+            ("upload_assets", "prepare_shaders", "geometry_pass",
+             "lighting_pass", "draw_lights"),
+            history=statsHistory
+        )
+        self.stats = self.timer.stats
+        self.resolution = None
+        if frameBudget is not None:
+            self.resolution = ResolutionController(frameBudget)
+        self.showStats = SHOW_STATS
+        # created the first time it is shown
+        self.statsOverlay = None
+        self.capture = None
+
+        # set up bound and enabled things directly, start from unknown
+        self.gl.invalidate()
+        self.set_render_scale(1.0)
+
+    def createShader(self, vertexFilepath, fragmentFilepath, defines=()):
 
         with open(vertexFilepath, 'r') as f:
-            vertex_src = f.readlines()
+            vertex_src = f.read()
 
         with open(fragmentFilepath, 'r') as f:
-            fragment_src = f.readlines()
+            fragment_src = f.read()
 
-        temp1 = compileShader(vertex_src, GL_VERTEX_SHADER)
-        temp2 = compileShader(fragment_src, GL_FRAGMENT_SHADER)
+        # defines go right after the #version line
+        header = "".join(f"#define {name}\n" for name in defines)
+        if header:
+            vertex_src = vertex_src.replace("\n", "\n" + header, 1)
+            fragment_src = fragment_src.replace("\n", "\n" + header, 1)
 
-        shader = compileProgram(temp1,
-                                temp2)
+        shader, locations = self.programCache.load(vertex_src, fragment_src)
+        self.uniformLocations[shader] = locations["uniforms"]
 
         return shader
 
+    def uniform(self, shader, name):
+        """
+            Location of a uniform from the program's cached table,
+            -1 (ignored by glUniform*) when it is not active.
+        """
+        return self.uniformLocations[shader].get(name, -1)
+
+    def set_render_scale(self, scale):
+        """
+            Render the geometry and lighting passes into the bottom left
+            scale * output size corner of the full size targets.
+        """
+
+        self.renderScale = scale
+        self.renderWidth = max(1, round(self.width * scale))
+        self.renderHeight = max(1, round(self.height * scale))
+
+        lightingShaders = [self.shaderLPass]
+        if self.lightingMode == "light_volumes":
+            lightingShaders.append(self.shaderLVolume)
+        for shader in lightingShaders:
+            self.gl.use_program(shader)
+            self.gl.call(glUniform2f, self.uniform(shader, "viewportSize"),
+                         self.renderWidth, self.renderHeight)
+
+        if self.lightingMode == "tiled":
+            self.gl.use_program(self.shaderLPass)
+            self.gl.call(glUniform1i, self.uniform(self.shaderLPass, "tilesX"),
+                         -(-self.renderWidth // TILE_SIZE))
+
     def get_uniform_locations(self):
 
         glUseProgram(self.shaderGPass)
-        self.viewLocgPass = glGetUniformLocation(self.shaderGPass, "view")
+        self.viewLocgPass = self.uniform(self.shaderGPass, "view")
+        self.timeLocgPass = self.uniform(self.shaderGPass, "time")
 
         glUseProgram(self.shaderLPass)
-        self.lightLocTextured = {
-
-            "pos": [
-                glGetUniformLocation(
-                    self.shaderLPass, f"lights[{i}].position"
-                )
-                for i in range(LIGHTS_NUMBER)
-            ],
-
-            "color": [
-                glGetUniformLocation(
-                    self.shaderLPass, f"lights[{i}].color"
-                )
-                for i in range(LIGHTS_NUMBER)
-            ],
-
-            "strength": [
-                glGetUniformLocation(
-                    self.shaderLPass, f"lights[{i}].strength"
-                )
-                for i in range(LIGHTS_NUMBER)
-            ],
-
-            "count": glGetUniformLocation(
-                self.shaderLPass, f"lightCount"
-            )
-        }
-
-        self.cameraLocTextured = glGetUniformLocation(
-            self.shaderLPass, "viewPos")
+        self.lightCountLoc = self.uniform(self.shaderLPass, "lightCount")
+
+        self.cameraLocTextured = self.uniform(self.shaderLPass, "viewPos")
+        self.inverseViewProjectionLocLPass = self.uniform(
+            self.shaderLPass, "inverseViewProjection")
+
+        if self.lightingMode == "light_volumes":
+            glUseProgram(self.shaderLVolume)
+            self.viewLocLVolume = self.uniform(self.shaderLVolume, "view")
+            self.cameraLocLVolume = self.uniform(self.shaderLVolume, "viewPos")
+            self.inverseViewProjectionLocLVolume = self.uniform(
+                self.shaderLVolume, "inverseViewProjection")
+            self.firstLightLocLVolume = self.uniform(
+                self.shaderLVolume, "firstLight")
+
+            glUseProgram(self.shaderLStencil)
+            self.viewLocLStencil = self.uniform(self.shaderLStencil, "view")
+            self.firstLightLocLStencil = self.uniform(
+                self.shaderLStencil, "firstLight")
 
         glUseProgram(self.shaderColored)
-        self.viewLocUntextured = glGetUniformLocation(
-            self.shaderColored, "view")
-        self.modelLocUntextured = glGetUniformLocation(
-            self.shaderColored, "model")
-        self.colorLocUntextured = glGetUniformLocation(
-            self.shaderColored, "color")
+        self.viewLocUntextured = self.uniform(self.shaderColored, "view")
 
     def set_initial_uniform_values(self):
 
         projection_transform = pyrr.matrix44.create_perspective_projection(
-            fovy=90, aspect=WIDTH/HEIGHT,
+            fovy=90, aspect=self.width/self.height,
             near=0.1, far=40, dtype=np.float32
         )
+        self.projection_transform = projection_transform
 
         glUseProgram(self.shaderGPass)
         glUniformMatrix4fv(
-            glGetUniformLocation(
-                self.shaderGPass, "projection"
-            ),
+            self.uniform(self.shaderGPass, "projection"),
             1, GL_FALSE, projection_transform
         )
 
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderGPass, "material.diffuse"
-            ), 0
+            self.uniform(self.shaderGPass, "material.diffuse"), 0
         )
 
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderGPass, "material.ao"
-            ), 1
+            self.uniform(self.shaderGPass, "material.specular"), 1
         )
 
-        glUniform1i(
-            glGetUniformLocation(
-                self.shaderGPass, "material.normal"
-            ), 2
+        glUseProgram(self.shaderLPass)
+        glUniform3fv(
+            self.uniform(self.shaderLPass, "ambient"),
+            1, np.array([0.1, 0.1, 0.1], dtype=np.float32)
         )
 
+        # unit 0 holds position, or depth in the compact layout
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderGPass, "material.specular"
-            ), 3
+            self.uniform(self.shaderLPass, "fragmentData.position"), 0
         )
 
-        glUseProgram(self.shaderLPass)
-        glUniform3fv(
-            glGetUniformLocation(
-                self.shaderLPass, "ambient"
-            ),
-            1, np.array([0.1, 0.1, 0.1], dtype=np.float32)
+        glUniform1i(
+            self.uniform(self.shaderLPass, "fragmentData.depth"), 0
         )
 
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderLPass, "fragmentData.position"
-            ), 0
+            self.uniform(self.shaderLPass, "fragmentData.diffuseSpecular"), 1
         )
 
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderLPass, "fragmentData.diffuseSpecular"
-            ), 1
+            self.uniform(self.shaderLPass, "fragmentData.normal"), 2
         )
 
         glUniform1i(
-            glGetUniformLocation(
-                self.shaderLPass, "fragmentData.normalAo"
-            ), 2
+            self.uniform(self.shaderLPass, "lightData"), 3
+        )
+
+        glUniform2f(
+            self.uniform(self.shaderLPass, "screenSize"),
+            self.width, self.height
         )
 
+        if self.lightingMode == "tiled":
+            glUniform1i(
+                self.uniform(self.shaderLPass, "tileData"), 4
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLPass, "lightIndices"), 5
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLPass, "tileSize"), TILE_SIZE
+            )
+
+        if self.lightingMode == "light_volumes":
+            glUseProgram(self.shaderLVolume)
+            glUniformMatrix4fv(
+                self.uniform(self.shaderLVolume, "projection"),
+                1, GL_FALSE, projection_transform
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLVolume, "fragmentData.position"), 0
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLVolume, "fragmentData.depth"), 0
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLVolume, "fragmentData.diffuseSpecular"),
+                1
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLVolume, "fragmentData.normal"), 2
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLVolume, "lightData"), 3
+            )
+
+            glUniform2f(
+                self.uniform(self.shaderLVolume, "screenSize"),
+                self.width, self.height
+            )
+
+            glUseProgram(self.shaderLStencil)
+            glUniformMatrix4fv(
+                self.uniform(self.shaderLStencil, "projection"),
+                1, GL_FALSE, projection_transform
+            )
+
+            glUniform1i(
+                self.uniform(self.shaderLStencil, "lightData"), 3
+            )
+
         glUseProgram(self.shaderColored)
         glUniformMatrix4fv(
-            glGetUniformLocation(
-                self.shaderColored, "projection"
-            ), 1, GL_FALSE, projection_transform
+            self.uniform(self.shaderColored, "projection"),
+            1, GL_FALSE, projection_transform
         )
 
+        glUseProgram(self.shaderOverlay)
+        glUniform1i(self.uniform(self.shaderOverlay, "overlay"), 0)
+
     def create_assets(self, scene):
 
         glUseProgram(self.shaderGPass)
-        self.material = Material()
-        self.cube_mesh = ObjMesh("models/cube.obj")
-
-        self.cubeTransforms = np.array([
-            pyrr.matrix44.create_identity(dtype=np.float32)
-
-            for i in range(len(scene.cubes))
-        ], dtype=np.float32)
-        glBindVertexArray(self.cube_mesh.vao)
-        self.cubeTransformVBO = glGenBuffers(1)
-        glBindBuffer(
-            GL_ARRAY_BUFFER,
-            self.cubeTransformVBO
-        )
-        glBufferData(
-            GL_ARRAY_BUFFER,
-            self.cubeTransforms.nbytes,
-            self.cubeTransforms,
-            GL_STATIC_DRAW
-        )
-        glEnableVertexAttribArray(5)
-        glVertexAttribPointer(5, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(6)
-        glVertexAttribPointer(6, 4, GL_FLOAT, GL_FALSE,
-                              64, ctypes.c_void_p(16))
-        glEnableVertexAttribArray(7)
-        glVertexAttribPointer(7, 4, GL_FLOAT, GL_FALSE,
-                              64, ctypes.c_void_p(32))
-        glEnableVertexAttribArray(8)
-        glVertexAttribPointer(8, 4, GL_FLOAT, GL_FALSE,
-                              64, ctypes.c_void_p(48))
-        glVertexAttribDivisor(5, 1)
-        glVertexAttribDivisor(6, 1)
-        glVertexAttribDivisor(7, 1)
-        glVertexAttribDivisor(8, 1)
+        self.assets = AssetLoader(self.gl, self.meshCache)
+
+        # image layers are streamed in over the placeholder color
+        self.materials = MaterialArray(scene.materials)
+        for layer, (diffuse, _) in enumerate(scene.materials):
+            if isinstance(diffuse, str):
+                self.assets.load_texture(diffuse, self.materials.textures[0],
+                                         layer, self.materials.size)
+
+        # meshes are drawn as the placeholder until they have loaded
+        self.placeholderMesh = ObjMesh(PLACEHOLDER_MESH, cache=self.meshCache)
+        self.enable_instance_attributes(self.placeholderMesh)
+        self.meshes = [self.placeholderMesh] * len(scene.meshes)
+        for i, filename in enumerate(scene.meshes):
+            if filename != PLACEHOLDER_MESH:
+                self.assets.load_mesh(
+                    filename, functools.partial(self.set_mesh, scene, i))
+
+        # level of detail each cube was last drawn at
+        self.cubeLods = np.zeros(len(scene.cubes), dtype=np.int64)
+        self.cubeGrid = None
+        if len(scene.cubes) >= GRID_MIN_INSTANCES:
+            self.cubeGrid = UniformGrid(
+                scene.cubes.positions, GRID_CELL_SIZE, 0)
+        self.visibleCubeCount = 0
+
+        # every material is drawn by the geometry pass program
+        self.renderQueue = RenderQueue(
+            [self.shaderGPass] * len(scene.materials), len(self.meshes))
+        self.update_mesh_bounds(scene)
+        # per vao, the byte offset its instance attributes point at
+        self.instanceOffsets = {}
+
+        if self.cubeAnimation == "gpu":
+            # static (position, eulers, euler velocity) per cube, stored in
+            # draw order, attributes 5-7 read straight from it
+            self.cubeRows = np.empty(len(scene.cubes), dtype=np.int64)
+            self.cubeRows[self.renderQueue.build(
+                scene.cubes.materialIds, scene.cubes.meshIds,
+                self.cubeLods)] = np.arange(len(scene.cubes))
+            self.cubeParameters = np.zeros((len(scene.cubes), 9),
+                                           dtype=np.float32)
+            self.cubeParameterBuffer = glGenBuffers(1)
+            glBindBuffer(GL_ARRAY_BUFFER, self.cubeParameterBuffer)
+            glBufferData(GL_ARRAY_BUFFER, self.cubeParameters.nbytes,
+                         None, GL_STATIC_DRAW)
+            self.update_cube_parameters(scene)
+            self.visibleCubeCount = len(scene.cubes)
+        else:
+            self.cubeTransforms = np.tile(
+                pyrr.matrix44.create_identity(dtype=np.float32),
+                (len(scene.cubes), 1, 1)
+            )
+            self.cubeTransformBuffer = StreamingBuffer(
+                self.cubeTransforms.nbytes)
+            self.instanceOffset = self.cubeTransformBuffer.upload(
+                self.cubeTransforms)
 
         glUseProgram(self.shaderLPass)
         self.screenQuad = ScreenQuad(0, 0, 2, 2)
 
+        # light data, read in the shader as a texture buffer
+        self.lightData = np.zeros((len(scene.lights), 2, 4), dtype=np.float32)
+        self.lightBuffer = glGenBuffers(1)
+        glBindBuffer(GL_TEXTURE_BUFFER, self.lightBuffer)
+        glBufferData(GL_TEXTURE_BUFFER, self.lightData.nbytes,
+                     self.lightData, GL_STREAM_DRAW)
+        self.lightTexture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_BUFFER, self.lightTexture)
+        glTexBuffer(GL_TEXTURE_BUFFER, GL_RGBA32F, self.lightBuffer)
+
+        # per tile (offset, count) and the light index lists they point into
+        if self.lightingMode == "tiled":
+            self.tileBuffer, self.lightIndexBuffer = glGenBuffers(2)
+            self.tileTexture, self.lightIndexTexture = glGenTextures(2)
+            for buffer, texture, format in (
+                (self.tileBuffer, self.tileTexture, GL_RG32I),
+                (self.lightIndexBuffer, self.lightIndexTexture, GL_R32I)
+            ):
+                glBindBuffer(GL_TEXTURE_BUFFER, buffer)
+                glBufferData(GL_TEXTURE_BUFFER, 8, None, GL_STREAM_DRAW)
+                glBindTexture(GL_TEXTURE_BUFFER, texture)
+                glTexBuffer(GL_TEXTURE_BUFFER, format, buffer)
+
         glUseProgram(self.shaderColored)
         self.light_mesh = UntexturedCubeMesh(
             l=0.1,
@@ -423,58 +1435,182 @@ class Engine:
             h=0.1
         )
 
+        # per instance position and color, read straight from the
+        # packed light data: (position, strength), (color, radius)
+        glBindBuffer(GL_ARRAY_BUFFER, self.lightBuffer)
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
+        glVertexAttribDivisor(1, 1)
+        glEnableVertexAttribArray(2)
+        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE,
+                              32, ctypes.c_void_p(16))
+        glVertexAttribDivisor(2, 1)
+
+        if self.lightingMode == "light_volumes":
+            self.sphere_mesh = SphereMesh(slices=16, stacks=8)
+
     def create_framebuffer(self):
 
         # geometry buffer
         self.gBuffer = glGenFramebuffers(1)
         glBindFramebuffer(GL_FRAMEBUFFER, self.gBuffer)
+        self.gBufferTargets = []
 
-        # position data
-        self.gPosition = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, self.gPosition)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA16F, WIDTH,
-                     HEIGHT, 0, GL_RGBA, GL_FLOAT, None)
+        # position data, the compact layout reads the depth buffer instead
+        if self.gBufferLayout == "full":
+            self.gPosition = self.create_gbuffer_target(
+                GL_RGBA16F, GL_RGBA, GL_FLOAT)
+
+        # diffuse data + specular (RGB diffuse, A specular)
+        self.gDiffuseSpecular = self.create_gbuffer_target(
+            GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE)
+
+        # world space normal, octahedral encoded in the compact layout
+        if self.gBufferLayout == "compact":
+            self.gNormal = self.create_gbuffer_target(
+                GL_RG16, GL_RG, GL_UNSIGNED_SHORT)
+        else:
+            self.gNormal = self.create_gbuffer_target(
+                GL_RGBA16F, GL_RGBA, GL_FLOAT)
+
+        self.gBufferDrawBuffers = [
+            GL_COLOR_ATTACHMENT0 + i for i in range(len(self.gBufferTargets))
+        ]
+        glDrawBuffers(len(self.gBufferDrawBuffers), self.gBufferDrawBuffers)
+
+        # depth-stencil
+        self.gDepthStencil = self.create_depth_stencil_texture()
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_STENCIL_ATTACHMENT,
+                               GL_TEXTURE_2D, self.gDepthStencil, 0)
+
+        # the compact layout samples depth from a copy made after the
+        # geometry pass: the lighting passes render with gDepthStencil
+        # attached, reading it at the same time would be a feedback loop
+        if self.gBufferLayout == "compact":
+            self.gDepthCopy = self.create_depth_stencil_texture()
+            self.depthCopyBuffer = glGenFramebuffers(1)
+            glBindFramebuffer(GL_FRAMEBUFFER, self.depthCopyBuffer)
+            glFramebufferTexture2D(GL_FRAMEBUFFER,
+                                   GL_DEPTH_STENCIL_ATTACHMENT,
+                                   GL_TEXTURE_2D, self.gDepthCopy, 0)
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+
+        # what the lighting shaders sample on units 0, 1 and 2
+        self.gBufferTextures = (
+            self.gPosition if self.gBufferLayout == "full"
+            else self.gDepthCopy,
+            self.gDiffuseSpecular,
+            self.gNormal
+        )
+
+        # lighting accumulates into its own color target at the render
+        # resolution, sharing the geometry depth-stencil (light volumes use
+        # its stencil to bound each light), then gets scaled to the output
+        self.lBuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.lBuffer)
+
+        self.lColor = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.lColor)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height,
+                     0, GL_RGBA, GL_UNSIGNED_BYTE, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
-                               GL_TEXTURE_2D, self.gPosition, 0)
+                               GL_TEXTURE_2D, self.lColor, 0)
+        glFramebufferTexture2D(GL_FRAMEBUFFER,
+                               GL_DEPTH_STENCIL_ATTACHMENT,
+                               GL_TEXTURE_2D, self.gDepthStencil, 0)
 
-        # diffuse data + specular (RGB diffuse, A specular)
-        self.gDiffuseSpecular = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, self.gDiffuseSpecular)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, WIDTH, HEIGHT,
-                     0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def create_gbuffer_target(self, internalFormat, format, type):
+        """
+            Screen sized texture attached to the next color
+            attachment of the currently bound gBuffer.
+        """
+
+        texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, self.width,
+                     self.height, 0, format, type, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glFramebufferTexture2D(
+            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + len(self.gBufferTargets),
+            GL_TEXTURE_2D, texture, 0)
+        self.gBufferTargets.append(texture)
+
+        return texture
+
+    def create_depth_stencil_texture(self):
+        """
+            Screen sized depth-stencil texture, depth can be sampled.
+        """
+
+        texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, texture)
+        # PyOpenGL's wrapper has no array type for GL_UNSIGNED_INT_24_8
+        rawGL10.glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH24_STENCIL8,
+                             self.width, self.height, 0, GL_DEPTH_STENCIL,
+                             GL_UNSIGNED_INT_24_8, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT1,
-                               GL_TEXTURE_2D, self.gDiffuseSpecular, 0)
 
-        glDrawBuffers(3, (GL_COLOR_ATTACHMENT0,
-                      GL_COLOR_ATTACHMENT1, GL_COLOR_ATTACHMENT2))
+        return texture
+
+    def bind_gbuffer_textures(self):
+
+        for i, texture in enumerate(self.gBufferTextures):
+            self.gl.bind_texture(i, GL_TEXTURE_2D, texture)
+
+    def draw(self, scene, simulation=None):
+        gl = self.gl
 
-        # depth-stencil
-        self.gDepthStencil = glGenRenderbuffers(1)
-        glBindRenderbuffer(GL_RENDERBUFFER, self.gDepthStencil)
-        glRenderbufferStorage(
-            GL_RENDERBUFFER, GL_DEPTH24_STENCIL8, WIDTH, HEIGHT)
-        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_STENCIL_ATTACHMENT,
-                                  GL_RENDERBUFFER, self.gDepthStencil)
-
-    def draw(self, scene):
         # refresh screen
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.bind_framebuffer(GL_FRAMEBUFFER, 0)
+        gl.set(glClearColor, 0.1, 0.1, 0.1, 1)
+        gl.call(glClear, GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        # timings lag a frame behind, the controller allows for that
+        if self.resolution is not None and len(self.stats) > 0:
+            _, _, gpu = self.stats.rows(1)
+            scale = self.resolution.update(float(np.nansum(gpu)))
+            if scale != self.renderScale:
+                self.set_render_scale(scale)
+
+        with self.timer.measure("upload_assets"):
+            self.assets.update()
+
+        with self.timer.measure("prepare_shaders"):
+            self.prepare_shaders(scene, simulation)
+
+        with self.timer.measure("geometry_pass"):
+            self.geometry_pass(scene)
 
-        self.prepare_shaders(scene)
+        with self.timer.measure("lighting_pass"):
+            self.lighting_pass()
 
-        self.geometry_pass(scene)
+        with self.timer.measure("draw_lights"):
+            self.draw_lights(scene)
 
-        self.lighting_pass()
+        self.timer.end_frame()
 
-        self.draw_lights(scene)
+        # before the overlay, which is not part of the image
+        if self.capture is not None:
+            self.capture_frame()
 
-        pg.display.flip()
+        if self.showStats:
+            if self.statsOverlay is None:
+                self.statsOverlay = StatsOverlay(
+                    self.timer.passes, self.width, self.height, gl)
+            self.statsOverlay.update(self.stats, gl.frameCalls)
+            gl.use_program(self.shaderOverlay)
+            self.statsOverlay.draw()
 
-    def prepare_shaders(self, scene):
+        gl.end_frame()
+
+    def prepare_shaders(self, scene, simulation=None):
 
         # view
         view_transform = pyrr.matrix44.create_look_at(
@@ -484,137 +1620,1177 @@ class Engine:
             dtype=np.float32
         )
 
-        glUseProgram(self.shaderGPass)
-        glUniformMatrix4fv(
-            self.viewLocgPass, 1, GL_FALSE, view_transform
-        )
+        gl = self.gl
 
-        glUseProgram(self.shaderLPass)
-        glUniform3fv(self.cameraLocTextured, 1, scene.camera.position)
+        gl.use_program(self.shaderGPass)
+        gl.call(glUniformMatrix4fv,
+                self.viewLocgPass, 1, GL_FALSE, view_transform)
 
-        glUseProgram(self.shaderColored)
-        glUniformMatrix4fv(self.viewLocUntextured, 1, GL_FALSE, view_transform)
+        gl.use_program(self.shaderLPass)
+        gl.call(glUniform3fv, self.cameraLocTextured, 1,
+                scene.camera.position)
 
-        # lights
-        glUseProgram(self.shaderLPass)
-        glUniform1f(self.lightLocTextured["count"], min(
-            LIGHTS_NUMBER, max(0, len(scene.lights))))
+        gl.use_program(self.shaderColored)
+        gl.call(glUniformMatrix4fv,
+                self.viewLocUntextured, 1, GL_FALSE, view_transform)
 
-        for i, light in enumerate(scene.lights):
-            glUniform3fv(self.lightLocTextured["pos"][i], 1, light.position)
-            glUniform3fv(self.lightLocTextured["color"][i], 1, light.color)
-            glUniform1f(self.lightLocTextured["strength"][i], 1)
+        if self.lightingMode == "light_volumes":
+            gl.use_program(self.shaderLVolume)
+            gl.call(glUniformMatrix4fv,
+                    self.viewLocLVolume, 1, GL_FALSE, view_transform)
+            gl.call(glUniform3fv, self.cameraLocLVolume, 1,
+                    scene.camera.position)
 
-        # cube positions
-        glUseProgram(self.shaderGPass)
+            gl.use_program(self.shaderLStencil)
+            gl.call(glUniformMatrix4fv,
+                    self.viewLocLStencil, 1, GL_FALSE, view_transform)
 
-        for i, cube in enumerate(scene.cubes):
-            model_transform = pyrr.matrix44.create_identity(dtype=np.float32)
-            model_transform = pyrr.matrix44.multiply(
-                m1=model_transform,
-                m2=pyrr.matrix44.create_from_eulers(
-                    eulers=np.radians(cube.eulers), dtype=np.float32
-                )
+        # the compact layout rebuilds world positions from depth
+        if self.gBufferLayout == "compact":
+            inverse_view_projection = np.linalg.inv(
+                view_transform @ self.projection_transform
+            ).astype(np.float32)
+
+            gl.use_program(self.shaderLPass)
+            gl.call(glUniformMatrix4fv, self.inverseViewProjectionLocLPass,
+                    1, GL_FALSE, inverse_view_projection)
+
+            if self.lightingMode == "light_volumes":
+                gl.use_program(self.shaderLVolume)
+                gl.call(glUniformMatrix4fv,
+                        self.inverseViewProjectionLocLVolume,
+                        1, GL_FALSE, inverse_view_projection)
+
+        # lights
+        gl.use_program(self.shaderLPass)
+        # light volumes only use the full screen pass for ambient light
+        if self.lightingMode == "light_volumes":
+            gl.call(glUniform1i, self.lightCountLoc, 0)
+        else:
+            gl.call(glUniform1i, self.lightCountLoc, len(scene.lights))
+
+        if len(self.lightData) != len(scene.lights):
+            self.lightData = np.zeros((len(scene.lights), 2, 4), dtype=np.float32)
+        pack_lights(scene.lights, self.lightData)
+        gl.call(glBindBuffer, GL_TEXTURE_BUFFER, self.lightBuffer)
+        gl.call(glBufferData, GL_TEXTURE_BUFFER, self.lightData.nbytes,
+                self.lightData, GL_STREAM_DRAW)
+
+        if self.lightingMode == "tiled":
+            tiles, indices = bin_lights(
+                scene.lights.positions, scene.lights.radii,
+                view_transform, self.projection_transform,
+                self.renderWidth, self.renderHeight, TILE_SIZE
             )
-            model_transform = pyrr.matrix44.multiply(
-                m1=model_transform,
-                m2=pyrr.matrix44.create_from_translation(
-                    vec=np.array(cube.position), dtype=np.float32
-                )
+            if len(indices) == 0:
+                indices = np.zeros(1, dtype=np.int32)
+            gl.call(glBindBuffer, GL_TEXTURE_BUFFER, self.tileBuffer)
+            gl.call(glBufferData, GL_TEXTURE_BUFFER, tiles.nbytes,
+                    tiles, GL_STREAM_DRAW)
+            gl.call(glBindBuffer, GL_TEXTURE_BUFFER, self.lightIndexBuffer)
+            gl.call(glBufferData, GL_TEXTURE_BUFFER, indices.nbytes,
+                    indices, GL_STREAM_DRAW)
+
+        # cube positions, only the ones inside the view frustum are packed
+        gl.use_program(self.shaderGPass)
+
+        cubes = scene.cubes
+        if self.cubeAnimation == "gpu":
+            # everything else is already on the gpu, only a change of
+            # level of detail moves cubes to other batches
+            gl.call(glUniform1f, self.timeLocgPass, scene.time)
+            if self.update_lods(scene, slice(None)):
+                self.cubeRows[self.renderQueue.build(
+                    cubes.materialIds, cubes.meshIds, self.cubeLods)] \
+                    = np.arange(len(cubes))
+                self.update_cube_parameters(scene)
+            return
+
+        planes = frustum_planes(view_transform, self.projection_transform)
+        if self.cubeGrid is not None:
+            self.cubeGrid.update(cubes.positions)
+            visible = self.cubeGrid.query(planes)
+        else:
+            visible = np.flatnonzero(spheres_in_frustum(
+                cubes.positions, self.cubeRadii, planes))
+        self.update_lods(scene, visible)
+        # packed in draw order, each batch reads a contiguous slice
+        visible = visible[self.renderQueue.build(
+            cubes.materialIds[visible], cubes.meshIds[visible],
+            self.cubeLods[visible])]
+        self.visibleCubeCount = len(visible)
+
+        if simulation is not None:
+            simulation.interpolate(
+                visible, out=self.cubeTransforms[:len(visible)])
+        else:
+            create_model_transforms(
+                positions=cubes.positions[visible],
+                eulers=cubes.eulers[visible],
+                out=self.cubeTransforms[:len(visible)]
             )
-            self.cubeTransforms[i] = model_transform
 
-        glBindVertexArray(self.cube_mesh.vao)
-        glBindBuffer(
-            GL_ARRAY_BUFFER,
-            self.cubeTransformVBO
-        )
-        glBufferData(GL_ARRAY_BUFFER, self.cubeTransforms.nbytes,
-                     self.cubeTransforms, GL_STATIC_DRAW)
+        self.instanceOffset = self.cubeTransformBuffer.upload(
+            self.cubeTransforms, stop=64 * len(visible))
+
+    def enable_instance_attributes(self, mesh):
+        """
+            Instance attributes of mesh's vao, they are pointed at
+            each batch's slice when it is drawn.
+        """
+
+        self.gl.bind_vertex_array(mesh.vao)
+        for i in range(3 if self.cubeAnimation == "gpu" else 4):
+            glEnableVertexAttribArray(5 + i)
+            glVertexAttribDivisor(5 + i, 1)
+
+    def set_mesh(self, scene, index, mesh):
+        """
+            Put a loaded mesh in place of the placeholder at index.
+        """
+
+        self.enable_instance_attributes(mesh)
+        self.meshes[index] = mesh
+        self.update_mesh_bounds(scene)
+
+    def update_mesh_bounds(self, scene):
+        """
+            Culling radius and level of detail count of every cube,
+            after the meshes changed.
+        """
+
+        # bounding sphere of each cube under any rotation
+        meshRadii = np.array([
+            np.linalg.norm(mesh.vertices[:, 0:3], axis=1).max()
+            for mesh in self.meshes
+        ], dtype=np.float32)
+        self.cubeRadii = meshRadii[scene.cubes.meshIds]
+        if self.cubeGrid is not None:
+            self.cubeGrid.radius = float(meshRadii.max())
+
+        levelCounts = np.array([len(mesh.lods) for mesh in self.meshes])
+        self.cubeLevelCounts = levelCounts[scene.cubes.meshIds]
+        self.renderQueue.levelCount = int(levelCounts.max())
+
+    def update_lods(self, scene, indices):
+        """
+            Pick the level of detail of the cubes at indices from their
+            distance to the camera, returns whether any of them changed.
+        """
+
+        if self.renderQueue.levelCount == 1:
+            return False
+
+        distances = np.linalg.norm(
+            scene.cubes.positions[indices] - scene.camera.position, axis=1)
+        current = self.cubeLods[indices]
+        lods = select_lods(distances, current, LOD_DISTANCES,
+                           LOD_HYSTERESIS, self.cubeLevelCounts[indices])
+        # current can be a view of cubeLods
+        changed = bool((lods != current).any())
+        self.cubeLods[indices] = lods
+
+        return changed
+
+    def update_cube_parameters(self, scene, indices=None):
+        """
+            Upload the position, eulers and euler velocity of the cubes at
+            indices (all of them by default) for gpu animation. Eulers are
+            taken as the orientation at time 0. Each cube's mesh and
+            material must be the ones it had when the engine was created.
+        """
+
+        if indices is None:
+            indices = np.arange(len(scene.cubes))
+        indices = np.asarray(indices)
+        if len(indices) == 0:
+            return
+
+        cubes = scene.cubes
+        rows = self.cubeRows[indices]
+        self.cubeParameters[rows, 0:3] = cubes.positions[indices]
+        self.cubeParameters[rows, 3:6] = cubes.eulers[indices]
+        self.cubeParameters[rows, 6:9] = cubes.eulerVelocities[indices]
+
+        # one upload covering every changed row
+        first, last = rows.min(), rows.max() + 1
+        rows = self.cubeParameters[first:last]
+        self.gl.call(glBindBuffer, GL_ARRAY_BUFFER, self.cubeParameterBuffer)
+        self.gl.call(glBufferSubData, GL_ARRAY_BUFFER, int(first) * 36,
+                     rows.nbytes, rows)
+
+    def bind_instances(self, mesh, first):
+        """
+            Point the instance attributes of mesh's vao, which must be
+            bound, at this frame's instance data from instance first on:
+            model matrices (5-8), or the animation parameters (5-7).
+        """
+
+        if self.cubeAnimation == "gpu":
+            buffer, attributes, width = self.cubeParameterBuffer, 3, 3
+            offset = 36 * first
+        else:
+            buffer, attributes, width = self.cubeTransformBuffer.vbo, 4, 4
+            offset = self.instanceOffset + 64 * first
+        if self.instanceOffsets.get(mesh.vao) == offset:
+            return
+        self.instanceOffsets[mesh.vao] = offset
+
+        stride = 4 * width * attributes
+        self.gl.call(glBindBuffer, GL_ARRAY_BUFFER, buffer)
+        for i in range(attributes):
+            self.gl.call(glVertexAttribPointer, 5 + i, width, GL_FLOAT,
+                         GL_FALSE, stride,
+                         ctypes.c_void_p(offset + 4 * width * i))
 
     def geometry_pass(self, scene):
 
-        glUseProgram(self.shaderGPass)
-        glBindFramebuffer(GL_FRAMEBUFFER, self.gBuffer)
-        glClearColor(0.0, 0.0, 0.0, 1.0)
-        glDrawBuffers(3, (GL_COLOR_ATTACHMENT0,
-                      GL_COLOR_ATTACHMENT1, GL_COLOR_ATTACHMENT2))
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glEnable(GL_DEPTH_TEST)
-        self.material.use()
-        glDrawArraysInstanced(
-            GL_TRIANGLES, 0, self.cube_mesh.vertex_count, len(scene.cubes))
+        gl = self.gl
+
+        gl.bind_framebuffer(GL_FRAMEBUFFER, self.gBuffer)
+        gl.set(glClearColor, 0.0, 0.0, 0.0, 0.0)
+        gl.call(glClear, GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.set(glViewport, 0, 0, self.renderWidth, self.renderHeight)
+        gl.enable(GL_DEPTH_TEST)
+        # every material lives in the same texture arrays
+        self.materials.use(gl)
+
+        layer = None
+        for program, material, meshId, level, first, count in \
+                self.renderQueue.batches:
+            gl.use_program(program)
+            if (program, material) != layer:
+                gl.call(glUniform1i,
+                        self.uniform(program, "material.layer"), material)
+                layer = (program, material)
+            mesh = self.meshes[meshId]
+            gl.bind_vertex_array(mesh.vao)
+            self.bind_instances(mesh, first)
+            firstIndex, indexCount, baseVertex = mesh.lods[level]
+            gl.call(glDrawElementsInstancedBaseVertex,
+                    GL_TRIANGLES, indexCount, GL_UNSIGNED_INT,
+                    ctypes.c_void_p(4 * firstIndex), count, baseVertex)
+        if self.cubeAnimation == "cpu":
+            self.cubeTransformBuffer.fence()
+
+        # what the compact layout's lighting reads depth from
+        if self.gBufferLayout == "compact":
+            size = (0, 0, self.renderWidth, self.renderHeight)
+            gl.bind_framebuffer(GL_READ_FRAMEBUFFER, self.gBuffer)
+            gl.bind_framebuffer(GL_DRAW_FRAMEBUFFER, self.depthCopyBuffer)
+            gl.call(glBlitFramebuffer, *size, *size,
+                    GL_DEPTH_BUFFER_BIT, GL_NEAREST)
 
     def lighting_pass(self):
 
-        glUseProgram(self.shaderLPass)
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glActiveTexture(GL_TEXTURE0)
-        glBindTexture(GL_TEXTURE_2D, self.gPosition)
-        glActiveTexture(GL_TEXTURE1)
-        glBindTexture(GL_TEXTURE_2D, self.gDiffuseSpecular)
-        glBindVertexArray(self.screenQuad.vao)
-        glDrawArrays(GL_TRIANGLES, 0, 6)
-
-        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.gBuffer)
-        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
-        glBlitFramebuffer(0, 0, WIDTH, HEIGHT, 0, 0, WIDTH,
-                          HEIGHT, GL_DEPTH_BUFFER_BIT, GL_NEAREST)
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if self.lightingMode == "light_volumes":
+            self.light_volume_pass()
+            return
+
+        gl = self.gl
+
+        gl.use_program(self.shaderLPass)
+        gl.bind_framebuffer(GL_FRAMEBUFFER, self.lBuffer)
+        # depth belongs to the geometry pass, the quad must not test it
+        gl.disable(GL_DEPTH_TEST)
+        self.bind_gbuffer_textures()
+        gl.bind_texture(3, GL_TEXTURE_BUFFER, self.lightTexture)
+        if self.lightingMode == "tiled":
+            gl.bind_texture(4, GL_TEXTURE_BUFFER, self.tileTexture)
+            gl.bind_texture(5, GL_TEXTURE_BUFFER, self.lightIndexTexture)
+        gl.bind_vertex_array(self.screenQuad.vao)
+        gl.call(glDrawArrays, GL_TRIANGLES, 0, 6)
+        gl.enable(GL_DEPTH_TEST)
+
+        self.present()
+
+    def present(self):
+        """
+            Scale the lit image and its depth from the render resolution
+            up to the output, the forward passes after this draw on top.
+        """
+
+        gl = self.gl
+
+        gl.bind_framebuffer(GL_READ_FRAMEBUFFER, self.lBuffer)
+        gl.bind_framebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        source = (0, 0, self.renderWidth, self.renderHeight)
+        target = (0, 0, self.width, self.height)
+        if source == target:
+            gl.call(glBlitFramebuffer, *source, *target,
+                    GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT, GL_NEAREST)
+        else:
+            # depth can only be blitted with nearest filtering
+            gl.call(glBlitFramebuffer, *source, *target,
+                    GL_COLOR_BUFFER_BIT, GL_LINEAR)
+            gl.call(glBlitFramebuffer, *source, *target,
+                    GL_DEPTH_BUFFER_BIT, GL_NEAREST)
+        gl.bind_framebuffer(GL_FRAMEBUFFER, 0)
+        gl.set(glViewport, 0, 0, self.width, self.height)
+
+    def light_volume_pass(self):
+
+        gl = self.gl
+        lightCount = len(self.lightData)
+
+        gl.bind_framebuffer(GL_FRAMEBUFFER, self.lBuffer)
+        gl.set(glClearColor, 0.0, 0.0, 0.0, 1.0)
+        # depth is kept, it belongs to the geometry pass
+        gl.call(glClear, GL_COLOR_BUFFER_BIT | GL_STENCIL_BUFFER_BIT)
+        self.bind_gbuffer_textures()
+        gl.bind_texture(3, GL_TEXTURE_BUFFER, self.lightTexture)
+
+        # ambient
+        gl.use_program(self.shaderLPass)
+        gl.disable(GL_DEPTH_TEST)
+        gl.bind_vertex_array(self.screenQuad.vao)
+        gl.call(glDrawArrays, GL_TRIANGLES, 0, 6)
+
+        gl.bind_vertex_array(self.sphere_mesh.vao)
+        gl.set(glDepthMask, GL_FALSE)
+        gl.enable(GL_STENCIL_TEST)
+        # volumes reaching past the near or far plane are clamped, not
+        # clipped, so every pixel a light marks is shaded and reset again
+        gl.enable(GL_DEPTH_CLAMP)
+        gl.set(glCullFace, GL_FRONT)
+        gl.set(glBlendEquation, GL_FUNC_ADD)
+        gl.set(glBlendFunc, GL_ONE, GL_ONE)
+        # one light at a time, so each only shades the surfaces inside its
+        # own volume and costs its own coverage
+        for light in range(lightCount):
+
+            # stencil: mark the visible surface points inside the volume,
+            # back faces behind the surface increment, front faces behind
+            # it decrement (still correct with the camera inside it)
+            gl.use_program(self.shaderLStencil)
+            gl.call(glUniform1i, self.firstLightLocLStencil, light)
+            gl.enable(GL_DEPTH_TEST)
+            gl.set(glColorMask, GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+            gl.disable(GL_CULL_FACE)
+            gl.disable(GL_BLEND)
+            gl.set(glStencilFunc, GL_ALWAYS, 0, 0xFF)
+            gl.stencil_op(GL_BACK, GL_KEEP, GL_INCR_WRAP, GL_KEEP)
+            gl.stencil_op(GL_FRONT, GL_KEEP, GL_DECR_WRAP, GL_KEEP)
+            gl.call(glDrawArrays,
+                    GL_TRIANGLES, 0, self.sphere_mesh.vertex_count)
+
+            # shading: back faces, so a volume around the camera still
+            # draws, over the marked pixels, which are reset to 0 for the
+            # next light as they are shaded
+            gl.use_program(self.shaderLVolume)
+            gl.call(glUniform1i, self.firstLightLocLVolume, light)
+            gl.disable(GL_DEPTH_TEST)
+            gl.set(glColorMask, GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+            gl.enable(GL_CULL_FACE)
+            gl.enable(GL_BLEND)
+            gl.set(glStencilFunc, GL_NOTEQUAL, 0, 0xFF)
+            gl.stencil_op(GL_FRONT_AND_BACK, GL_KEEP, GL_KEEP, GL_ZERO)
+            gl.call(glDrawArrays,
+                    GL_TRIANGLES, 0, self.sphere_mesh.vertex_count)
+
+        gl.disable(GL_BLEND)
+        gl.set(glCullFace, GL_BACK)
+        gl.disable(GL_DEPTH_CLAMP)
+        gl.disable(GL_STENCIL_TEST)
+        gl.set(glDepthMask, GL_TRUE)
+        gl.enable(GL_DEPTH_TEST)
+
+        self.present()
 
     def draw_lights(self, scene):
 
-        glUseProgram(self.shaderColored)
-        for light in scene.lights:
-            model_transform = pyrr.matrix44.create_from_translation(
-                vec=np.array(light.position), dtype=np.float32
-            )
-            glUniformMatrix4fv(self.modelLocUntextured, 1,
-                               GL_FALSE, model_transform)
-            glUniform3fv(self.colorLocUntextured, 1, light.color)
-            glBindVertexArray(self.light_mesh.vao)
-            glDrawArrays(GL_TRIANGLES, 0, self.light_mesh.vertex_count)
+        self.gl.use_program(self.shaderColored)
+        self.gl.bind_vertex_array(self.light_mesh.vao)
+        self.gl.call(glDrawArraysInstanced, GL_TRIANGLES, 0,
+                     self.light_mesh.vertex_count, len(scene.lights))
+
+    def start_capture(self, output, source="output",
+                      latency=CAPTURE_LATENCY):
+        """
+            Capture source (see CAPTURE_SOURCE) of every frame drawn from
+            now on to output, a png filename pattern with a {frame} field
+            or a raw RGBA stream: a filename or a binary file object.
+        """
+
+        names = ["output", "lighting", "depth", "diffuseSpecular", "normal"]
+        if self.gBufferLayout == "full":
+            names.append("position")
+        if source not in names:
+            raise ValueError(f"can not capture {source!r}, "
+                             f"expected one of {names}")
+
+        if self.capture is not None:
+            self.stop_capture()
+        self.captureSource = source
+        self.capture = FrameCapture(self.gl, output, self.width,
+                                    self.height, latency)
+
+    def stop_capture(self):
+        """
+            Write out the frames still in flight, waits for the GPU and
+            the writer.
+        """
+        self.capture.close()
+        self.capture = None
+
+    def capture_frame(self):
+
+        source = self.captureSource
+        if source == "output":
+            self.capture.read(0, None, self.width, self.height)
+            return
+
+        # the passes before the output only fill the render size corner
+        size = (self.renderWidth, self.renderHeight)
+        if source == "lighting":
+            self.capture.read(self.lBuffer, GL_COLOR_ATTACHMENT0, *size)
+        elif source == "depth":
+            self.capture.read(self.gBuffer, None, *size, depth=True)
+        else:
+            texture = {
+                "position": getattr(self, "gPosition", None),
+                "diffuseSpecular": self.gDiffuseSpecular,
+                "normal": self.gNormal
+            }[source]
+            attachment = self.gBufferTargets.index(texture)
+            self.capture.read(self.gBuffer,
+                              GL_COLOR_ATTACHMENT0 + attachment, *size)
 
     def quit(self):
-        self.cube_mesh.destroy()
+        if self.capture is not None:
+            self.stop_capture()
+        self.assets.shutdown()
+        for mesh in set(self.meshes) | {self.placeholderMesh}:
+            mesh.destroy()
         self.light_mesh.destroy()
-        self.material.destroy()
+        self.materials.destroy()
         self.screenQuad.destroy()
-        glDeleteBuffers(1, (self.cubeTransformVBO,))
+        if self.cubeAnimation == "gpu":
+            glDeleteBuffers(1, (self.cubeParameterBuffer,))
+        else:
+            self.cubeTransformBuffer.destroy()
+        glDeleteBuffers(1, (self.lightBuffer,))
+        glDeleteTextures(1, (self.lightTexture,))
+        if self.lightingMode == "tiled":
+            glDeleteBuffers(2, (self.tileBuffer, self.lightIndexBuffer))
+            glDeleteTextures(2, (self.tileTexture, self.lightIndexTexture))
+        glDeleteFramebuffers(1, (self.lBuffer,))
+        glDeleteTextures(1, (self.lColor,))
+        if self.lightingMode == "light_volumes":
+            self.sphere_mesh.destroy()
         glDeleteFramebuffers(1, (self.gBuffer,))
-        glDeleteTextures(
-            3, (self.gPosition, self.gDiffuseSpecular, self.gNormalAo))
-        glDeleteProgram(self.shaderGPass)
-        glDeleteProgram(self.shaderLPass)
-        glDeleteProgram(self.shaderColored)
-        pg.quit()
+        glDeleteTextures(len(self.gBufferTargets), self.gBufferTargets)
+        glDeleteTextures(1, (self.gDepthStencil,))
+        if self.gBufferLayout == "compact":
+            glDeleteFramebuffers(1, (self.depthCopyBuffer,))
+            glDeleteTextures(1, (self.gDepthCopy,))
+        if self.ownsProgramCache:
+            self.programCache.destroy()
+        self.timer.destroy()
+        if self.statsOverlay is not None:
+            self.statsOverlay.destroy()
+
+
+class StreamingBuffer:
+    """
+        Per-instance data streamed through a ring of equally sized regions
+        inside one GL_STREAM_DRAW buffer. Each upload writes the next region
+        through an unsynchronized mapping, a fence per region makes sure the
+        GPU has finished reading it before it is written again. Only the
+        byte ranges that changed since a region was last written get copied.
+    """
+
+    def __init__(self, capacity, regions=3):
+
+        self.capacity = capacity
+        self.regions = regions
+        self.region = 0
+        self.fences = [None] * regions
+        # pending (start, stop) byte range per region, None when up to date
+        self.dirty = [(0, capacity)] * regions
+
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, capacity * regions,
+                     None, GL_STREAM_DRAW)
+
+    @property
+    def offset(self):
+        return self.region * self.capacity
+
+    def upload(self, data, start=0, stop=None):
+        """
+            data holds the full contents of a region, start/stop is the
+            byte range of it that changed since the previous upload.
+            Returns the byte offset of the region to draw from.
+        """
+
+        stop = min(data.nbytes if stop is None else stop, self.capacity)
+        if start < stop:
+            for i in range(self.regions):
+                if self.dirty[i] is None:
+                    self.dirty[i] = (start, stop)
+                else:
+                    self.dirty[i] = (min(self.dirty[i][0], start),
+                                     max(self.dirty[i][1], stop))
+
+        if self.dirty[self.region] is None:
+            return self.offset
+
+        self.region = (self.region + 1) % self.regions
+        self.wait(self.region)
+
+        if self.dirty[self.region] is not None:
+            start, stop = self.dirty[self.region]
+            stop = min(stop, data.nbytes)
+            if start < stop:
+                glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+                pointer = glMapBufferRange(
+                    GL_ARRAY_BUFFER, self.offset + start, stop - start,
+                    GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_RANGE_BIT
+                    | GL_MAP_UNSYNCHRONIZED_BIT
+                )
+                ctypes.memmove(pointer, data.ctypes.data + start, stop - start)
+                glUnmapBuffer(GL_ARRAY_BUFFER)
+            self.dirty[self.region] = None
 
+        return self.offset
 
-class Material:
-    def __init__(self):
+    def fence(self):
+        """
+            Mark the current region as in use by the commands issued so far.
+        """
+
+        if self.fences[self.region] is not None:
+            glDeleteSync(self.fences[self.region])
+        self.fences[self.region] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def wait(self, region):
+
+        fence = self.fences[region]
+        if fence is None:
+            return
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT,
+                               1000000) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+        self.fences[region] = None
+
+    def destroy(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        glDeleteBuffers(1, (self.vbo,))
+
+
+class FrameCapture:
+    """
+        Frames read back without stalling: glReadPixels goes into the next
+        of a ring of pixel pack buffers and returns at once, the buffer is
+        mapped when its turn comes round again, latency frames later, by
+        when the GPU has long finished the copy. The pixels are then
+        encoded on a pool of threads, as png or raw (RGBA, top row first),
+        and a writer thread saves them in frame order as numbered png files
+        or appends them to a file or pipe.
+    """
+
+    def __init__(self, gl, output, width, height, latency=CAPTURE_LATENCY,
+                 queueSize=8, encoders=CAPTURE_ENCODERS,
+                 level=CAPTURE_PNG_LEVEL):
+
+        self.gl = gl
+        self.output = output
+        self.png = isinstance(output, str) and output.lower().endswith(".png")
+        self.stream = None
+        if not self.png:
+            self.stream = open(output, "wb") \
+                if isinstance(output, (str, os.PathLike)) else output
+        self.ownsStream = self.stream is not output
+        self.level = level
+
+        # 4 bytes per pixel, RGBA8 or float depth
+        self.capacity = 4 * width * height
+        self.pbos = glGenBuffers(latency)
+        if latency == 1:
+            self.pbos = [self.pbos]
+        for pbo in self.pbos:
+            gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, pbo)
+            gl.call(glBufferData, GL_PIXEL_PACK_BUFFER, self.capacity,
+                    None, GL_STREAM_READ)
+        gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, 0)
+        self.fences = [None] * latency
+        # (frame, width, height, depth) waiting to be mapped per buffer
+        self.pending = [None] * latency
+        self.slot = 0
+        self.frame = 0
+
+        # (frame, future of its bytes) in frame order, a writer falling
+        # behind makes read() wait rather than drop frames
+        self.frames = queue.Queue(queueSize)
+        self.encoders = concurrent.futures.ThreadPoolExecutor(encoders)
+        self.error = None
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def read(self, framebuffer, buffer, width, height, depth=False):
+        """
+            Start reading the bottom left width x height pixels of
+            framebuffer's buffer (None: its current read buffer), or of its
+            depth. Returns the frame number the pixels are written as.
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        gl = self.gl
+        slot = self.slot
+        self.collect(slot)
+
+        gl.bind_framebuffer(GL_READ_FRAMEBUFFER, framebuffer)
+        if buffer is not None:
+            gl.call(glReadBuffer, buffer)
+        gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        format, type = (GL_DEPTH_COMPONENT, GL_FLOAT) if depth \
+            else (GL_RGBA, GL_UNSIGNED_BYTE)
+        # the wrapped glReadPixels would read into a new array instead
+        gl.call(rawGL10.glReadPixels, 0, 0, width, height, format, type,
+                ctypes.c_void_p(0))
+        gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, 0)
+        self.fences[slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.pending[slot] = (self.frame, width, height, depth)
+
+        self.slot = (slot + 1) % len(self.pbos)
+        self.frame += 1
+        return self.frame - 1
+
+    def collect(self, slot):
+
+        if self.pending[slot] is None:
+            return
 
-        self.textures = []
+        fence = self.fences[slot]
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT,
+                               1000000) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+        self.fences[slot] = None
+
+        frame, width, height, depth = self.pending[slot]
+        pixels = np.empty(4 * width * height, dtype=np.uint8)
+        self.gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, pixels.nbytes,
+                                   GL_MAP_READ_BIT)
+        ctypes.memmove(pixels.ctypes.data, pointer, pixels.nbytes)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        self.gl.call(glBindBuffer, GL_PIXEL_PACK_BUFFER, 0)
+        self.pending[slot] = None
+
+        self.frames.put((frame, self.encoders.submit(
+            self.encode, width, height, depth, pixels)))
+
+    def flush(self):
+        """
+            Hand every frame still in flight to the writer, waits for the
+            GPU.
+        """
+        for i in range(len(self.pbos)):
+            self.collect((self.slot + i) % len(self.pbos))
+
+    def encode(self, width, height, depth, pixels):
+        """
+            File contents of one frame, runs on the encoder threads.
+        """
+
+        if depth:
+            grey = np.round(255 * pixels.view(np.float32))
+            pixels = np.repeat(grey.astype(np.uint8), 4)
+            pixels[3::4] = 255
+        # GL rows start at the bottom
+        pixels = pixels.reshape(height, width, 4)[::-1]
+
+        if self.png:
+            return encode_png(pixels, self.level)
+        return pixels.tobytes()
+
+    def write(self):
+
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            # after a failure frames are only drained, read() raises it
+            if self.error is not None:
+                continue
+
+            frame, encoded = item
+            try:
+                if self.png:
+                    with open(self.output.format(frame=frame), "wb") as f:
+                        f.write(encoded.result())
+                else:
+                    self.stream.write(encoded.result())
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        """
+            Write out every frame read so far and stop the writer.
+        """
+
+        self.flush()
+        self.frames.put(None)
+        self.writer.join()
+        self.encoders.shutdown()
+        if self.stream is not None:
+            if self.ownsStream:
+                self.stream.close()
+            else:
+                self.stream.flush()
+        glDeleteBuffers(len(self.pbos), self.pbos)
+        if self.error is not None:
+            raise self.error
+
+
+class ResolutionController:
+    """
+        Chooses the render scale that keeps the measured GPU frame time
+        within budget. Frame cost is taken to follow the pixel count, so
+        the scale moves by sqrt(target / time). It only shrinks once over
+        budget and only grows once under headroom * budget. Steps are
+        quantized and held for cooldown frames, which gives the timings
+        of the new size time to arrive.
+    """
+
+    def __init__(self, budget, minScale=MIN_RENDER_SCALE, maxScale=1.0,
+                 step=0.05, cooldown=10, smoothing=0.2, headroom=0.85):
+
+        self.budget = budget
+        self.minScale = minScale
+        self.maxScale = maxScale
+        self.step = step
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.headroom = headroom
+
+        self.scale = maxScale
+        self.frameTime = None
+        self.wait = 0
+
+    def update(self, frameTime):
+        """
+            Feed in the latest frame time, returns the scale to render at.
+        """
+
+        if np.isnan(frameTime):
+            return self.scale
+        if self.frameTime is None:
+            self.frameTime = frameTime
+        else:
+            self.frameTime += self.smoothing * (frameTime - self.frameTime)
+
+        if self.wait > 0:
+            self.wait -= 1
+            return self.scale
+
+        target = self.headroom * self.budget
+        if target <= self.frameTime <= self.budget:
+            return self.scale
+
+        scale = self.scale * np.sqrt(target / max(self.frameTime, 1e-3))
+        scale = round(round(scale / self.step) * self.step, 6)
+        scale = float(np.clip(scale, self.minScale, self.maxScale))
+        if scale != self.scale:
+            self.scale = scale
+            self.wait = self.cooldown
+            # timings at the old size no longer apply
+            self.frameTime = None
+
+        return self.scale
+
+
+class FrameStats:
+    """
+        Rolling record of the CPU and GPU milliseconds each pass took,
+        one row per frame, the newest history frames are kept.
+        A pass that did not run in a frame is NaN.
+    """
+
+    def __init__(self, passes, history=STATS_HISTORY):
+
+        self.passes = tuple(passes)
+        self.history = history
+        self.count = 0
+        self.frames = np.zeros(history, dtype=np.int64)
+        self.cpu = np.zeros((history, len(self.passes)))
+        self.gpu = np.zeros((history, len(self.passes)))
+
+    def __len__(self):
+        return min(self.count, self.history)
+
+    def record(self, frame, cpu, gpu):
+
+        row = self.count % self.history
+        self.frames[row] = frame
+        self.cpu[row] = cpu
+        self.gpu[row] = gpu
+        self.count += 1
+
+    def rows(self, last=None):
+        """
+            (frames, cpu, gpu) of the last frames recorded, oldest first,
+            cpu and gpu are (frames, passes) arrays in milliseconds.
+        """
+
+        n = len(self) if last is None else min(last, len(self))
+        rows = np.arange(self.count - n, self.count) % self.history
+        return self.frames[rows], self.cpu[rows], self.gpu[rows]
+
+    def summary(self, last=None):
+        """
+            Percentiles per pass, and for the whole frame, over the
+            last frames recorded.
+        """
+
+        _, cpu, gpu = self.rows(last)
+        summary = {}
+        for i, name in enumerate(self.passes):
+            summary[name] = {
+                "cpu_ms": summarize(cpu[:, i]),
+                "gpu_ms": summarize(gpu[:, i])
+            }
+        summary["frame"] = {
+            "cpu_ms": summarize(np.nansum(cpu, axis=1)),
+            "gpu_ms": summarize(np.nansum(gpu, axis=1))
+        }
+        return summary
+
+    def dump(self, filename):
+        """
+            Write every kept frame to filename,
+            as json if it ends in .json, csv otherwise.
+        """
+
+        frames, cpu, gpu = self.rows()
+
+        if filename.endswith(".json"):
+            with open(filename, "w") as f:
+                json.dump({
+                    "passes": self.passes,
+                    "summary": self.summary(),
+                    "frames": [{
+                        "frame": int(frame),
+                        "cpu_ms": dict(zip(self.passes, cpu[i].tolist())),
+                        "gpu_ms": dict(zip(self.passes, gpu[i].tolist()))
+                    } for i, frame in enumerate(frames)]
+                }, f, indent=4)
+            return
 
-        # diffuse : 0
-        self.textures.append(glGenTextures(1))
-        glBindTexture(GL_TEXTURE_2D, self.textures[0])
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 1, 1, 0, GL_RGBA,
-                     GL_UNSIGNED_BYTE, (255, 255, 255, 0))
-        glGenerateMipmap(GL_TEXTURE_2D)
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["frame"]
+                + [f"{name}_cpu_ms" for name in self.passes]
+                + [f"{name}_gpu_ms" for name in self.passes]
+            )
+            for i, frame in enumerate(frames):
+                writer.writerow(
+                    [int(frame)] + cpu[i].tolist() + gpu[i].tolist())
+
+
+class PassTimer:
+    """
+        CPU time and GL_TIME_ELAPSED queries around named passes. Query
+        sets are double buffered: a frame's results are read back at the
+        end of the next frame, when the GPU has long finished them, so
+        the readback does not stall. Results are recorded into self.stats.
+    """
+
+    def __init__(self, passes, history=STATS_HISTORY, latency=2):
+
+        self.passes = tuple(passes)
+        self.stats = FrameStats(self.passes, history)
+        self.latency = latency
+        self.queries = [glGenQueries(len(self.passes)) for _ in range(latency)]
+        self.cpu = np.zeros((latency, len(self.passes)))
+        self.used = np.zeros((latency, len(self.passes)), dtype=bool)
+        # frame number waiting to be read back per query set
+        self.pending = [None] * latency
+        self.slot = 0
+        self.frame = 0
+
+    @contextlib.contextmanager
+    def measure(self, name):
+
+        index = self.passes.index(name)
+        glBeginQuery(GL_TIME_ELAPSED, self.queries[self.slot][index])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.cpu[self.slot, index] = 1000 * (time.perf_counter() - start)
+            glEndQuery(GL_TIME_ELAPSED)
+            self.used[self.slot, index] = True
+
+    def end_frame(self):
+
+        self.pending[self.slot] = self.frame
+        self.frame += 1
+        self.slot = (self.slot + 1) % self.latency
+        # the set about to be reused holds the oldest frame in flight
+        self.collect(self.slot)
+
+    def collect(self, slot):
+
+        if self.pending[slot] is None:
+            return
 
-        # specular : 1
-        self.textures.append(glGenTextures(1))
-        glBindTexture(GL_TEXTURE_2D, self.textures[1])
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 1, 1, 0, GL_RGBA,
-                     GL_UNSIGNED_BYTE, (255, 255, 255, 0))
-        glGenerateMipmap(GL_TEXTURE_2D)
+        used = self.used[slot]
+        gpu = np.full(len(self.passes), np.nan)
+        for i in np.flatnonzero(used):
+            gpu[i] = query_result(self.queries[slot][i]) / 1e6
+        cpu = np.where(used, self.cpu[slot], np.nan)
+        self.stats.record(self.pending[slot], cpu, gpu)
+
+        self.pending[slot] = None
+        used[:] = False
+
+    def flush(self):
+        """
+            Read back every frame still in flight, waits for the GPU.
+        """
+        for i in range(self.latency):
+            self.collect((self.slot + i) % self.latency)
+
+    def destroy(self):
+        for queries in self.queries:
+            glDeleteQueries(len(queries), queries)
 
-    def use(self):
+
+class GLState:
+    """
+        Shadow copy of the GL state the Engine changes while drawing a
+        frame. A change to the value the state already has is skipped
+        instead of reaching the driver, each one is counted as issued or
+        skipped. Anything that changes the same state without going
+        through here must be followed by invalidate().
+    """
+
+    def __init__(self):
+
+        # state key -> last value set, missing when unknown
+        self.state = {}
+        self.issued = 0
+        self.skipped = 0
+        # (issued, skipped) of the last finished frame
+        self.frameCalls = (0, 0)
+
+    def invalidate(self, *keys):
+        """
+            Forget the given state keys, or everything.
+        """
+
+        if not keys:
+            self.state.clear()
+        for key in keys:
+            self.state.pop(key, None)
+
+    def changed(self, key, value):
+        """
+            Record value for key, False (and counted as skipped) when
+            it was already set.
+        """
+
+        if key in self.state and self.state[key] == value:
+            self.skipped += 1
+            return False
+        self.state[key] = value
+        self.issued += 1
+        return True
+
+    def call(self, function, *args):
+        """
+            Untracked call (draws, blits, clears, uploads), only counted.
+        """
+        self.issued += 1
+        return function(*args)
+
+    def set(self, function, *args):
+        """
+            Call a setter whose arguments are the whole state it sets,
+            eg. glClearColor, glViewport, glDepthMask or glBlendFunc.
+        """
+        if self.changed(function, args):
+            function(*args)
+
+    def use_program(self, program):
+        if self.changed("program", program):
+            glUseProgram(program)
+
+    def bind_vertex_array(self, vao):
+        if self.changed("vertexArray", vao):
+            glBindVertexArray(vao)
+
+    def bind_framebuffer(self, target, framebuffer):
+
+        if target != GL_FRAMEBUFFER:
+            if self.changed(target, framebuffer):
+                glBindFramebuffer(target, framebuffer)
+            return
+
+        # binds both the read and the draw framebuffer
+        if self.state.get(GL_READ_FRAMEBUFFER) == framebuffer \
+                and self.state.get(GL_DRAW_FRAMEBUFFER) == framebuffer:
+            self.skipped += 1
+            return
+        self.state[GL_READ_FRAMEBUFFER] = framebuffer
+        self.state[GL_DRAW_FRAMEBUFFER] = framebuffer
+        self.issued += 1
+        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+
+    def active_texture(self, unit):
+        if self.changed("activeTexture", unit):
+            glActiveTexture(GL_TEXTURE0 + unit)
+
+    def bind_texture(self, unit, target, texture):
+        if self.changed(("texture", unit, target), texture):
+            self.active_texture(unit)
+            glBindTexture(target, texture)
+
+    def enable(self, capability):
+        if self.changed(capability, True):
+            glEnable(capability)
+
+    def disable(self, capability):
+        if self.changed(capability, False):
+            glDisable(capability)
+
+    def stencil_op(self, face, stencilFail, depthFail, depthPass):
+
+        operations = (stencilFail, depthFail, depthPass)
+        faces = (GL_FRONT, GL_BACK) if face == GL_FRONT_AND_BACK else (face,)
+        if all(self.state.get(("stencilOp", f)) == operations
+               for f in faces):
+            self.skipped += 1
+            return
+        for f in faces:
+            self.state[("stencilOp", f)] = operations
+        self.issued += 1
+        glStencilOpSeparate(face, *operations)
+
+    def end_frame(self):
+
+        self.frameCalls = (self.issued, self.skipped)
+        self.issued = 0
+        self.skipped = 0
+
+
+class RenderQueue:
+    """
+        Draw list of the geometry pass. Instances are ordered by program,
+        then material, then mesh, then level of detail, and every run
+        sharing all four becomes one instanced draw over its slice of the
+        instance data.
+    """
+
+    def __init__(self, materialPrograms, meshCount, levelCount=1):
+
+        self.materialPrograms = list(materialPrograms)
+        self.meshCount = meshCount
+        self.levelCount = levelCount
+        # materials ranked by their program, sorting by rank groups both
+        ranked = sorted(range(len(self.materialPrograms)),
+                        key=lambda m: (self.materialPrograms[m], m))
+        self.materialRanks = np.empty(len(ranked), dtype=np.int64)
+        self.materialRanks[ranked] = np.arange(len(ranked))
+        # (program, material, mesh, level, first, count) per draw
+        self.batches = []
+
+    def build(self, materials, meshes, levels=None):
+        """
+            Sort instances with these (N,) material, mesh and level ids
+            (all level 0 by default), returns the order to pack their
+            instance data in and fills self.batches with the runs of it.
+        """
+
+        keys = (self.materialRanks[materials] * self.meshCount + meshes) \
+            * self.levelCount
+        if levels is not None:
+            keys += levels
+        if len(self.materialRanks) * self.meshCount * self.levelCount \
+                <= np.iinfo(np.int16).max:
+            # small keys get numpy's radix sort
+            keys = keys.astype(np.int16)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        firsts = np.flatnonzero(np.diff(keys, prepend=-1))
+        counts = np.diff(np.append(firsts, len(keys)))
+        self.batches = []
+        for first, count in zip(firsts.tolist(), counts.tolist()):
+            instance = order[first]
+            material = int(materials[instance])
+            self.batches.append((
+                self.materialPrograms[material], material,
+                int(meshes[instance]),
+                0 if levels is None else int(levels[instance]),
+                first, count
+            ))
+
+        return order
+
+
+class MaterialArray:
+    """
+        Every material as one layer of a diffuse and a specular
+        GL_TEXTURE_2D_ARRAY, so the textures are bound once per pass
+        and a draw only selects its layer. Materials are
+        (diffuse, specular) pairs, the diffuse is an rgb color or an
+        image file. Layers are 1x1 unless there are images, those are
+        left grey here to be streamed in later. Specular is only ever a
+        color, its array stays 1x1.
+    """
+
+    def __init__(self, materials):
+
+        self.size = 1
+        diffuse = np.zeros((len(materials), 4), dtype=np.uint8)
+        specular = np.zeros((len(materials), 4), dtype=np.uint8)
+        for i, (color, shininess) in enumerate(materials):
+            if isinstance(color, str):
+                self.size = MATERIAL_TEXTURE_SIZE
+                color = (0.5, 0.5, 0.5)
+            diffuse[i, 0:3] = np.round(255 * np.asarray(color))
+            specular[i, 0:3] = round(255 * shininess)
+
+        # diffuse : 0, specular : 1
+        self.textures = [self.create_array(diffuse, self.size),
+                         self.create_array(specular, 1)]
+
+    @staticmethod
+    def create_array(texels, size):
+        """
+            size x size texture array, layer i filled with texels[i].
+        """
+
+        pixels = np.ascontiguousarray(np.broadcast_to(
+            texels[:, np.newaxis, np.newaxis], (len(texels), size, size, 4)))
+        texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, texture)
+        glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_RGBA, size, size, len(texels),
+                     0, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+        glGenerateMipmap(GL_TEXTURE_2D_ARRAY)
+        if size > 1:
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER,
+                            GL_LINEAR_MIPMAP_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER,
+                            GL_LINEAR)
+
+        return texture
+
+    def use(self, gl):
 
         for i in range(len(self.textures)):
-            glActiveTexture(GL_TEXTURE0 + i)
-            glBindTexture(GL_TEXTURE_2D, self.textures[i])
+            gl.bind_texture(i, GL_TEXTURE_2D_ARRAY, self.textures[i])
 
     def destroy(self):
         glDeleteTextures(len(self.textures), self.textures)
@@ -691,20 +2867,78 @@ class UntexturedCubeMesh:
         glDeleteBuffers(1, (self.vbo,))
 
 
+class SphereMesh:
+
+    def __init__(self, slices, stacks):
+        # x, y, z of a uv sphere, pushed out so the faceted mesh
+        # encloses the unit sphere rather than sitting inside it
+        theta = np.linspace(0, 2 * np.pi, slices + 1)
+        phi = np.linspace(0, np.pi, stacks + 1)
+        scale = 1 / (np.cos(np.pi / slices) * np.cos(np.pi / (2 * stacks)))
+        grid = scale * np.stack((
+            np.outer(np.sin(phi), np.cos(theta)),
+            np.outer(np.sin(phi), np.sin(theta)),
+            np.outer(np.cos(phi), np.ones_like(theta))
+        ), axis=-1)
+
+        # two counter-clockwise (seen from outside) triangles per quad
+        a = grid[:-1, :-1]
+        b = grid[1:, :-1]
+        c = grid[1:, 1:]
+        d = grid[:-1, 1:]
+        self.vertices = np.stack(
+            (a, b, c, c, d, a), axis=2).reshape(-1, 3).astype(np.float32)
+        self.vertex_count = len(self.vertices)
+
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes,
+                     self.vertices, GL_STATIC_DRAW)
+
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(0))
+
+    def destroy(self):
+        glDeleteVertexArrays(1, (self.vao,))
+        glDeleteBuffers(1, (self.vbo,))
+
+
 class ObjMesh:
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None, lodCells=LOD_GRID_CELLS,
+                 levels=None, upload=True):
         # x, y, z, s, t, nx, ny, nz, tangent, bitangent, model(instanced)
-        self.vertices = self.loadMesh(filename)
-        self.vertex_count = len(self.vertices)//14
-        self.vertices = np.array(self.vertices, dtype=np.float32)
+        if levels is None:
+            levels = self.loadLevels(filename, cache, lodCells)
+        self.levels = levels
+        self.vertices, self.indices = levels[0]
+        self.vertex_count = len(self.vertices)
+        self.index_count = len(self.indices)
+
+        # levels share the buffers, (first index, index count,
+        # base vertex) of each
+        self.lods = []
+        firstIndex = baseVertex = 0
+        for vertices, indices in levels:
+            self.lods.append((firstIndex, len(indices), baseVertex))
+            firstIndex += len(indices)
+            baseVertex += len(vertices)
 
         self.vao = glGenVertexArrays(1)
         glBindVertexArray(self.vao)
         self.vbo = glGenBuffers(1)
         glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes,
-                     self.vertices, GL_STATIC_DRAW)
+        glBufferData(GL_ARRAY_BUFFER, 56 * baseVertex, None, GL_STATIC_DRAW)
+        self.ebo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, 4 * firstIndex,
+                     None, GL_STATIC_DRAW)
+        # otherwise the caller steps through upload()
+        if upload:
+            for _ in self.upload():
+                pass
         offset = 0
         # position
         glEnableVertexAttribArray(0)
@@ -732,124 +2966,667 @@ class ObjMesh:
                               56, ctypes.c_void_p(offset))
         offset += 12
 
-    def loadMesh(self, filename):
-
-        # raw, unassembled data
-        v = []
-        vt = []
-        vn = []
-
-        # final, assembled and packed result
-        vertices = []
+    def upload(self, chunkSize=None):
+        """
+            Copy the levels into the buffers, at most chunkSize bytes at
+            a time, yields the bytes copied by each step.
+        """
+
+        for (vertices, indices), (firstIndex, _, baseVertex) in zip(
+                self.levels, self.lods):
+            for buffer, offset, data in (
+                (self.vbo, 56 * baseVertex, vertices),
+                (self.ebo, 4 * firstIndex, indices)
+            ):
+                data = data.reshape(-1).view(np.uint8)
+                step = chunkSize or max(len(data), 1)
+                for start in range(0, len(data), step):
+                    chunk = data[start:start + step]
+                    # leaves the vao's element buffer binding alone
+                    glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+                    glBufferSubData(GL_COPY_WRITE_BUFFER, offset + start,
+                                    chunk.nbytes, chunk)
+                    yield chunk.nbytes
+
+    @classmethod
+    def loadLevels(cls, filename, cache=None, lodCells=LOD_GRID_CELLS):
+        """
+            (vertices, indices) of every level of detail, from the
+            name_lod1.obj, name_lod2.obj, ... files next to filename
+            or else simplified from it. Makes no GL calls. A cache keeps
+            the levels for as long as it lives.
+        """
+
+        key = (os.path.abspath(filename), tuple(lodCells))
+        if cache is not None and key in cache.levels:
+            return cache.levels[key]
+
+        levels = [cls.loadLevel(filename, cache)]
+        root, extension = os.path.splitext(filename)
+        if os.path.exists(f"{root}_lod1{extension}"):
+            while os.path.exists(f"{root}_lod{len(levels)}{extension}"):
+                levels.append(cls.loadLevel(
+                    f"{root}_lod{len(levels)}{extension}", cache))
+        else:
+            for cells in lodCells:
+                vertices, indices = simplify_mesh(*levels[0], cells)
+                # a level has to save something over the one before
+                if 0 < len(indices) < len(levels[-1][1]):
+                    levels.append((vertices, indices))
+
+        if cache is not None:
+            cache.levels[key] = levels
+        return levels
+
+    @classmethod
+    def loadLevel(cls, filename, cache=None):
+        if cache is not None:
+            return cache.load(filename)
+        return cls.loadMesh(filename)
+
+    @staticmethod
+    def loadMesh(filename):
+        """
+            Returns (vertices, indices): an (N,14) float32 array of unique
+            vertices and the uint32 triangle list indexing it.
+        """
 
-        # open the obj file and read the data
         with open(filename, 'r') as f:
-            line = f.readline()
-            while line:
-                firstSpace = line.find(" ")
-                flag = line[0:firstSpace]
-                if flag == "v":
-                    # vertex
-                    line = line.replace("v ", "")
-                    line = line.split(" ")
-                    l = [float(x) for x in line]
-                    v.append(l)
-                elif flag == "vt":
-                    # texture coordinate
-                    line = line.replace("vt ", "")
-                    line = line.split(" ")
-                    l = [float(x) for x in line]
-                    vt.append(l)
-                elif flag == "vn":
-                    # normal
-                    line = line.replace("vn ", "")
-                    line = line.split(" ")
-                    l = [float(x) for x in line]
-                    vn.append(l)
-                elif flag == "f":
-                    # face, three or more vertices in v/vt/vn form
-                    line = line.replace("f ", "")
-                    line = line.replace("\n", "")
-                    # get the individual vertices for each line
-                    line = line.split(" ")
-                    faceVertices = []
-                    faceTextures = []
-                    faceNormals = []
-                    for vertex in line:
-                        # break out into [v,vt,vn],
-                        # correct for 0 based indexing.
-                        l = vertex.split("/")
-                        position = int(l[0]) - 1
-                        faceVertices.append(v[position])
-                        texture = int(l[1]) - 1
-                        faceTextures.append(vt[texture])
-                        normal = int(l[2]) - 1
-                        faceNormals.append(vn[normal])
-                    # obj file uses triangle fan format for each face individually.
-                    # unpack each face
-                    triangles_in_face = len(line) - 2
-
-                    vertex_order = []
-                    """
-                        eg. 0,1,2,3 unpacks to vertices: [0,1,2,0,2,3]
-                    """
-                    for i in range(triangles_in_face):
-                        vertex_order.append(0)
-                        vertex_order.append(i+1)
-                        vertex_order.append(i+2)
-                    # calculate tangent and bitangent for point
-                    # how do model positions relate to texture positions?
-                    point1 = faceVertices[vertex_order[0]]
-                    point2 = faceVertices[vertex_order[1]]
-                    point3 = faceVertices[vertex_order[2]]
-                    uv1 = faceTextures[vertex_order[0]]
-                    uv2 = faceTextures[vertex_order[1]]
-                    uv3 = faceTextures[vertex_order[2]]
-                    # direction vectors
-                    deltaPos1 = [point2[i] - point1[i] for i in range(3)]
-                    deltaPos2 = [point3[i] - point1[i] for i in range(3)]
-                    deltaUV1 = [uv2[i] - uv1[i] for i in range(2)]
-                    deltaUV2 = [uv3[i] - uv1[i] for i in range(2)]
-                    # calculate
-                    den = 1 / (deltaUV1[0] * deltaUV2[1] -
-                               deltaUV2[0] * deltaUV1[1])
-                    tangent = []
-                    # tangent x
-                    tangent.append(
-                        den * (deltaUV2[1] * deltaPos1[0] - deltaUV1[1] * deltaPos2[0]))
-                    # tangent y
-                    tangent.append(
-                        den * (deltaUV2[1] * deltaPos1[1] - deltaUV1[1] * deltaPos2[1]))
-                    # tangent z
-                    tangent.append(
-                        den * (deltaUV2[1] * deltaPos1[2] - deltaUV1[1] * deltaPos2[2]))
-                    bitangent = []
-                    # bitangent x
-                    bitangent.append(
-                        den * (-deltaUV2[0] * deltaPos1[0] + deltaUV1[0] * deltaPos2[0]))
-                    # bitangent y
-                    bitangent.append(
-                        den * (-deltaUV2[0] * deltaPos1[1] + deltaUV1[0] * deltaPos2[1]))
-                    # bitangent z
-                    bitangent.append(
-                        den * (-deltaUV2[0] * deltaPos1[2] + deltaUV1[0] * deltaPos2[2]))
-                    for i in vertex_order:
-                        for x in faceVertices[i]:
-                            vertices.append(x)
-                        for x in faceTextures[i]:
-                            vertices.append(x)
-                        for x in faceNormals[i]:
-                            vertices.append(x)
-                        for x in tangent:
-                            vertices.append(x)
-                        for x in bitangent:
-                            vertices.append(x)
-                line = f.readline()
-        return vertices
+            text = f.read()
+
+        v = parse_floats(obj_lines(text, "v"), 3)
+        vt = parse_floats(obj_lines(text, "vt"), 2)
+        vn = parse_floats(obj_lines(text, "vn"), 3)
+
+        # face corners as (v, vt, vn), 0 based, -1 where not given
+        faceSizes, corners = parse_faces(obj_lines(text, "f"))
+        for i, flag in enumerate(("v", "vt", "vn")):
+            # obj indices are 1 based, negative ones count back from
+            # the last element defined before that face
+            if (corners[:, i] < 0).any():
+                defined = np.searchsorted(
+                    obj_line_starts(text, flag), obj_line_starts(text, "f"))
+                corners[:, i] = np.where(
+                    corners[:, i] < 0,
+                    corners[:, i] + np.repeat(defined, faceSizes),
+                    corners[:, i] - 1
+                )
+            else:
+                corners[:, i] -= 1
+        corners[corners[:, 0] < 0, 0] = 0
+
+        # obj file uses triangle fan format for each face individually.
+        # eg. 0,1,2,3 unpacks to vertices: [0,1,2,0,2,3]
+        faceStarts = np.cumsum(faceSizes) - faceSizes
+        triangleCounts = np.maximum(faceSizes - 2, 0)
+        triangleFaces = np.repeat(np.arange(len(faceSizes)), triangleCounts)
+        fan = np.arange(triangleCounts.sum()) - np.repeat(
+            np.cumsum(triangleCounts) - triangleCounts, triangleCounts)
+        triangles = faceStarts[triangleFaces, np.newaxis] + np.stack(
+            (np.zeros_like(fan), fan + 1, fan + 2), axis=1)
+
+        # tangent and bitangent from the first triangle of each face:
+        # how do model positions relate to texture positions?
+        hasFace = faceSizes >= 3
+        first = faceStarts[:, np.newaxis] + np.arange(3)
+        first = np.where(hasFace[:, np.newaxis], first, 0)
+        points = v[corners[first, 0]]
+        uvCorners = corners[first, 1]
+        uvs = np.zeros(uvCorners.shape + (2,))
+        if len(vt):
+            uvs = np.where(uvCorners[..., np.newaxis] >= 0,
+                           vt[np.maximum(uvCorners, 0)], 0)
+        deltaPos1 = points[:, 1] - points[:, 0]
+        deltaPos2 = points[:, 2] - points[:, 0]
+        deltaUV1 = uvs[:, 1] - uvs[:, 0]
+        deltaUV2 = uvs[:, 2] - uvs[:, 0]
+        faceNormals = normalize(np.cross(deltaPos1, deltaPos2))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            den = 1 / (deltaUV1[:, 0] * deltaUV2[:, 1]
+                       - deltaUV2[:, 0] * deltaUV1[:, 1])
+            den = den[:, np.newaxis]
+            tangents = den * (deltaUV2[:, 1:2] * deltaPos1
+                              - deltaUV1[:, 1:2] * deltaPos2)
+            bitangents = den * (-deltaUV2[:, 0:1] * deltaPos1
+                                + deltaUV1[:, 0:1] * deltaPos2)
+        # faces without usable texture coordinates get any basis
+        # perpendicular to their normal
+        degenerate = ~np.isfinite(den[:, 0])
+        tangents[degenerate] = normalize(deltaPos1[degenerate])
+        bitangents[degenerate] = np.cross(
+            faceNormals[degenerate], tangents[degenerate])
+
+        # unique (v, vt, vn) tuples become the vertices, in order of first use
+        sizes = np.array((len(v), len(vt) + 1, len(vn) + 1), dtype=object)
+        if np.prod(sizes) < 2 ** 63:
+            # pack each tuple into one int64, much faster to sort
+            packed = (corners[:, 0] * sizes[1] + corners[:, 1] + 1) \
+                * sizes[2] + corners[:, 2] + 1
+            _, firstUse, inverse = np.unique(
+                packed, return_index=True, return_inverse=True)
+            keys = corners[firstUse]
+        else:
+            keys, firstUse, inverse = np.unique(
+                corners, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(firstUse)
+        remap = np.empty_like(order)
+        remap[order] = np.arange(len(order))
+        keys = keys[order]
+        inverse = remap[inverse]
+
+        vertices = np.zeros((len(keys), 14), dtype=np.float32)
+        vertices[:, 0:3] = v[keys[:, 0]]
+        if len(vt):
+            vertices[:, 3:5] = np.where(
+                keys[:, 1:2] >= 0, vt[np.maximum(keys[:, 1], 0)], 0)
+        # corners shared by several faces average their face data
+        cornerFaces = np.repeat(np.arange(len(faceSizes)), faceSizes)
+        uses = np.bincount(inverse, minlength=len(keys))[:, np.newaxis]
+        for column, faceData in ((5, faceNormals), (8, tangents),
+                                 (11, bitangents)):
+            cornerData = faceData[cornerFaces]
+            for i in range(3):
+                vertices[:, column + i] = np.bincount(
+                    inverse, weights=cornerData[:, i], minlength=len(keys)
+                ) / np.maximum(uses[:, 0], 1)
+        vertices[:, 5:8] = normalize(vertices[:, 5:8])
+        given = keys[:, 2] >= 0
+        vertices[given, 5:8] = vn[keys[given, 2]]
+
+        indices = inverse[triangles].reshape(-1).astype(np.uint32)
+
+        return vertices, indices
 
     def destroy(self):
         glDeleteVertexArrays(1, (self.vao,))
-        glDeleteBuffers(1, (self.vbo,))
+        glDeleteBuffers(2, (self.vbo, self.ebo))
+
+
+class MeshCache:
+    """
+        Processed ObjMesh vertex and index arrays stored on disk, so a mesh
+        is only parsed the first time it is loaded. Each entry is a json
+        header followed by the raw arrays, which later loads memory-map
+        straight into glBufferData.
+        An entry is reused while the source's size and mtime match, or,
+        failing that, its sha1. Anything else rebuilds it. Without a
+        writable directory meshes are parsed on every load.
+    """
+
+    magic = b"OBJCACHE"
+    # bump whenever loadMesh changes its output
+    version = 1
+
+    def __init__(self, directory=MESH_CACHE_DIR):
+        self.directory = directory
+        # (source path, lod cells) -> every level, see ObjMesh.loadLevels
+        self.levels = {}
+
+    def entry_path(self, filename):
+        source = os.path.abspath(filename)
+        key = hashlib.sha1(source.encode()).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(source))[0]
+        return os.path.join(self.directory, f"{name}_{key}.mesh")
+
+    def load(self, filename):
+        """
+            Returns (vertices, indices) for filename, building the
+            cache entry first if it is missing or stale.
+        """
+
+        entry = self.entry_path(filename)
+        stat = os.stat(filename)
+        header = self.read_header(entry)
+
+        if header is not None:
+            if (header["size"], header["mtime"]) == \
+                    (stat.st_size, stat.st_mtime_ns):
+                return self.map_arrays(entry, header)
+            if header["sha1"] == self.hash_file(filename):
+                # touched but unchanged, only the stored mtime is stale,
+                # copied so no mapping holds the entry while it is replaced
+                vertices, indices = (
+                    np.array(array) for array in self.map_arrays(entry, header))
+                return self.store(filename, vertices, indices)
+
+        return self.build(filename)
+
+    def build(self, filename):
+
+        vertices, indices = ObjMesh.loadMesh(filename)
+        return self.store(filename, vertices, indices)
+
+    def store(self, filename, vertices, indices):
+        """
+            Write the entry of filename and return its arrays mapped back,
+            or the given arrays when it could not be written or read.
+        """
+
+        if self.write(filename, vertices, indices):
+            entry = self.entry_path(filename)
+            header = self.read_header(entry)
+            if header is not None:
+                return self.map_arrays(entry, header)
+        return vertices, indices
+
+    def prebuild(self, directory):
+        """
+            Build every missing or stale entry for the obj files found
+            under directory, returns the files that were checked.
+        """
+
+        filenames = []
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                if name.lower().endswith(".obj"):
+                    filenames.append(os.path.join(root, name))
+                    self.load(filenames[-1])
+
+        return filenames
+
+    def write(self, filename, vertices, indices):
+        """
+            Store an entry for filename, returns whether it was written.
+        """
+
+        stat = os.stat(filename)
+        header = json.dumps({
+            "version": self.version,
+            "source": os.path.abspath(filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha1": self.hash_file(filename),
+            "vertices": list(vertices.shape),
+            "indices": len(indices)
+        }).encode()
+        # keep the arrays 16 byte aligned
+        headerSize = -(-(len(self.magic) + 4 + len(header)) // 16) * 16
+
+        entry = self.entry_path(filename)
+        # a read-only checkout just runs without the cache
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # meshes can be loaded from several threads
+            temp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(self.magic)
+                f.write(np.uint32(headerSize).tobytes())
+                f.write(header.ljust(headerSize - len(self.magic) - 4))
+                f.write(np.ascontiguousarray(
+                    vertices, dtype=np.float32).tobytes())
+                f.write(np.ascontiguousarray(
+                    indices, dtype=np.uint32).tobytes())
+            os.replace(temp, entry)
+        except OSError:
+            return False
+        return True
+
+    def read_header(self, entry):
+        """
+            Parsed header of a cache entry, None if it is
+            missing, unreadable or from another version.
+        """
+
+        try:
+            with open(entry, "rb") as f:
+                if f.read(len(self.magic)) != self.magic:
+                    return None
+                headerSize = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+                header = json.loads(
+                    f.read(headerSize - len(self.magic) - 4))
+        except (OSError, ValueError, IndexError):
+            return None
+
+        if header.get("version") != self.version:
+            return None
+        header["offset"] = headerSize
+        return header
+
+    def map_arrays(self, entry, header):
+
+        if header["indices"] == 0:
+            return (np.zeros(header["vertices"], dtype=np.float32),
+                    np.zeros(0, dtype=np.uint32))
+        vertices = np.memmap(
+            entry, dtype=np.float32, mode="r", offset=header["offset"],
+            shape=tuple(header["vertices"])
+        )
+        indices = np.memmap(
+            entry, dtype=np.uint32, mode="r",
+            offset=header["offset"] + vertices.nbytes,
+            shape=(header["indices"],)
+        )
+        return vertices, indices
+
+    @staticmethod
+    def hash_file(filename):
+
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+
+class AssetLoader:
+    """
+        Meshes and textures decoded on a pool of worker threads, then
+        uploaded on the GL thread by update(), which stops once about
+        budget bytes went out, so large assets are spread over several
+        frames instead of stalling one. Texture data goes through a pixel
+        unpack buffer, the copy into the texture is left to the GPU.
+        Finished assets are handed to their callback on the GL thread.
+        An asset that fails to decode is reported and left out, whatever
+        stood in for it stays.
+    """
+
+    def __init__(self, gl, cache=None, workers=ASSET_WORKERS,
+                 budget=ASSET_UPLOAD_BUDGET):
+
+        self.gl = gl
+        self.cache = cache
+        self.budget = budget
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        # (future, upload, filename) per load, moved to ready once decoded
+        self.loading = []
+        self.ready = []
+        # (filename, exception) of the assets that failed to decode
+        self.failed = []
+        # generator of the upload in progress
+        self.upload = None
+        self.pbo = glGenBuffers(1)
+
+    def __len__(self):
+        """
+            Number of assets not uploaded yet.
+        """
+        return len(self.loading) + len(self.ready) + (self.upload is not None)
+
+    def submit(self, filename, upload, decode, *args):
+        """
+            Run decode(filename, *args) on a worker, then upload(result),
+            a generator yielding the bytes of each step, on the GL thread.
+        """
+        self.loading.append(
+            (self.pool.submit(decode, filename, *args), upload, filename))
+
+    def load_mesh(self, filename, callback, lodCells=LOD_GRID_CELLS):
+        """
+            ObjMesh of filename with its levels of detail,
+            callback(mesh) runs once it is on the GPU.
+        """
+        self.submit(
+            filename,
+            functools.partial(self.upload_mesh, filename, callback),
+            ObjMesh.loadLevels, self.cache, lodCells
+        )
+
+    def load_texture(self, filename, texture, layer, size, callback=None):
+        """
+            Image file scaled into a size x size layer of a texture
+            array, mip levels included, then callback(texture, layer).
+        """
+        self.submit(
+            filename,
+            functools.partial(self.upload_texture, texture, layer, callback),
+            self.decode_texture, size
+        )
+
+    @staticmethod
+    def decode_texture(filename, size):
+        """
+            Mip chain of an image scaled to size x size (a power of two),
+            (n, n, 4) uint8 arrays with the bottom row first.
+        """
+
+        image = pg.image.load(filename)
+        # smoothscale needs 32 bit pixels
+        surface = pg.Surface(image.get_size(), pg.SRCALPHA, 32)
+        surface.blit(image, (0, 0))
+        surface = pg.transform.smoothscale(surface, (size, size))
+        levels = [np.frombuffer(
+            pg.image.tostring(surface, "RGBA", True), dtype=np.uint8
+        ).reshape(size, size, 4)]
+
+        # box filtered halves down to 1x1
+        while len(levels[-1]) > 1:
+            pixels = levels[-1].astype(np.float32)
+            half = (pixels[0::2, 0::2] + pixels[1::2, 0::2]
+                    + pixels[0::2, 1::2] + pixels[1::2, 1::2]) / 4
+            levels.append(np.round(half).astype(np.uint8))
+
+        return levels
+
+    def upload_mesh(self, filename, callback, levels):
+
+        mesh = ObjMesh(filename, levels=levels, upload=False)
+        # the constructor left its vao bound
+        self.gl.invalidate("vertexArray")
+        yield from mesh.upload(self.budget)
+        callback(mesh)
+
+    def upload_texture(self, texture, layer, callback, levels):
+
+        gl = self.gl
+        for level, pixels in enumerate(levels):
+            height, width = pixels.shape[:2]
+            rows = max(1, self.budget // pixels[0].nbytes)
+            for y in range(0, height, rows):
+                band = np.ascontiguousarray(pixels[y:y + rows])
+                gl.call(glBindBuffer, GL_PIXEL_UNPACK_BUFFER, self.pbo)
+                # fresh storage, the previous band may still be in flight
+                gl.call(glBufferData, GL_PIXEL_UNPACK_BUFFER, band.nbytes,
+                        band, GL_STREAM_DRAW)
+                # the copy goes to the active unit's texture
+                gl.bind_texture(0, GL_TEXTURE_2D_ARRAY, texture)
+                gl.active_texture(0)
+                gl.call(glTexSubImage3D, GL_TEXTURE_2D_ARRAY, level,
+                        0, y, layer, width, len(band), 1,
+                        GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+                gl.call(glBindBuffer, GL_PIXEL_UNPACK_BUFFER, 0)
+                yield band.nbytes
+
+        if callback is not None:
+            callback(texture, layer)
+
+    def update(self, budget=None):
+        """
+            Upload decoded assets until budget (self.budget by default)
+            bytes went out or nothing is left, returns the bytes sent.
+        """
+
+        if budget is None:
+            budget = self.budget
+
+        loading = []
+        for load in self.loading:
+            if load[0].done():
+                self.ready.append(load)
+            else:
+                loading.append(load)
+        self.loading = loading
+
+        spent = 0
+        while spent < budget:
+            if self.upload is None:
+                if not self.ready:
+                    break
+                future, upload, filename = self.ready.pop(0)
+                error = future.exception()
+                if error is not None:
+                    # a missing or broken file must not end the session
+                    self.failed.append((filename, error))
+                    print(f"could not load {filename}: {error}",
+                          file=sys.stderr)
+                    continue
+                self.upload = upload(future.result())
+            try:
+                spent += next(self.upload)
+            except StopIteration:
+                self.upload = None
+
+        return spent
+
+    def finish(self):
+        """
+            Wait for every asset to be decoded and upload all of them.
+        """
+        concurrent.futures.wait([load[0] for load in self.loading])
+        self.update(float("inf"))
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        glDeleteBuffers(1, (self.pbo,))
+
+
+class ProgramCache:
+    """
+        Linked shader programs stored on disk with glGetProgramBinary, so
+        later runs skip compiling and linking. Entries are keyed by the
+        shader sources and the driver, and carry the program's uniform and
+        attribute location tables. A binary the driver rejects (eg. after
+        a driver update) is recompiled and replaced. Programs stay linked
+        until destroy(), loading the same sources again returns them.
+    """
+
+    magic = b"GLBINARY"
+    # bump whenever the entry layout changes
+    version = 1
+
+    def __init__(self, directory=PROGRAM_CACHE_DIR):
+        self.directory = directory
+        # entry path -> (program, locations) loaded so far
+        self.programs = {}
+        # needs GL 4.1 or ARB_get_program_binary, and at least one format
+        self.supported = bool(glProgramBinary) and \
+            glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+        self.driver = "\n".join(
+            glGetString(name).decode()
+            for name in (GL_VENDOR, GL_RENDERER, GL_VERSION)
+        )
+
+    def entry_path(self, vertex_src, fragment_src):
+        key = hashlib.sha1(
+            "\0".join((self.driver, vertex_src, fragment_src)).encode()
+        ).hexdigest()
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def load(self, vertex_src, fragment_src):
+        """
+            Returns (program, locations) for the given sources, locations
+            holds the "uniforms" and "attributes" name -> location tables.
+        """
+
+        entry = self.entry_path(vertex_src, fragment_src)
+        if entry in self.programs:
+            return self.programs[entry]
+        if self.supported:
+            cached = self.read(entry)
+            if cached is not None:
+                self.programs[entry] = cached
+                return cached
+
+        program = self.compile(vertex_src, fragment_src)
+        locations = self.query_locations(program)
+        if self.supported:
+            self.write(entry, program, locations)
+        self.programs[entry] = (program, locations)
+        return program, locations
+
+    def destroy(self):
+        for program, _ in self.programs.values():
+            glDeleteProgram(program)
+        self.programs.clear()
+
+    def compile(self, vertex_src, fragment_src):
+
+        vertex = compileShader(vertex_src, GL_VERTEX_SHADER)
+        fragment = compileShader(fragment_src, GL_FRAGMENT_SHADER)
+
+        # validation checks sampler units against the current GL state,
+        # which is only meaningful once uniforms are set and textures bound
+        program = compileProgram(vertex, fragment, validate=False,
+                                 retrievable=self.supported)
+        glDeleteShader(vertex)
+        glDeleteShader(fragment)
+
+        return program
+
+    @staticmethod
+    def query_locations(program):
+
+        uniforms = {}
+        for i in range(glGetProgramiv(program, GL_ACTIVE_UNIFORMS)):
+            name = glGetActiveUniform(program, i)[0].decode()
+            uniforms[name] = glGetUniformLocation(program, name)
+
+        attributes = {}
+        for i in range(glGetProgramiv(program, GL_ACTIVE_ATTRIBUTES)):
+            name = glGetActiveAttrib(program, i)[0].decode()
+            attributes[name] = glGetAttribLocation(program, name)
+
+        return {"uniforms": uniforms, "attributes": attributes}
+
+    def read(self, entry):
+        """
+            (program, locations) from a cache entry, None if it is
+            missing, unreadable or rejected by the driver.
+        """
+
+        try:
+            with open(entry, "rb") as f:
+                if f.read(len(self.magic)) != self.magic:
+                    return None
+                headerSize = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+                header = json.loads(f.read(headerSize))
+                binary = np.frombuffer(f.read(), dtype=np.uint8)
+        except (OSError, ValueError, IndexError):
+            return None
+
+        if header.get("version") != self.version \
+                or header.get("length") != len(binary):
+            return None
+
+        program = glCreateProgram()
+        try:
+            glProgramBinary(program, header["format"], binary, len(binary))
+        except GLError:
+            pass
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            glDeleteProgram(program)
+            return None
+
+        return program, header["locations"]
+
+    def write(self, entry, program, locations):
+
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        binary = np.zeros(length, dtype=np.uint8)
+        written = GLsizei()
+        binaryFormat = GLenum()
+        glGetProgramBinary(program, length, written, binaryFormat, binary)
+        binary = binary[:written.value]
+
+        header = json.dumps({
+            "version": self.version,
+            "format": binaryFormat.value,
+            "length": len(binary),
+            "locations": locations
+        }).encode()
+
+        # a read-only checkout just runs without the cache
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = f"{entry}.{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(self.magic)
+                f.write(np.uint32(len(header)).tobytes())
+                f.write(header)
+                f.write(binary.tobytes())
+            os.replace(temp, entry)
+        except OSError:
+            pass
 
 
 class ScreenQuad:
@@ -884,7 +3661,103 @@ class ScreenQuad:
         glDeleteVertexArrays(1, (self.vao,))
         glDeleteBuffers(1, (self.vbo,))
 
+
+class StatsOverlay:
+    """
+        Panel in the top left corner listing the mean CPU and GPU time of
+        each pass over the last refresh frames and the GL calls issued and
+        skipped by the state cache in the last frame. The text is drawn with
+        pygame's default font into a texture, redrawn every refresh frames.
+    """
+
+    def __init__(self, passes, width, height, gl, refresh=30):
+
+        pg.font.init()
+        self.font = pg.font.Font(None, 20)
+        self.passes = passes
+        self.gl = gl
+        self.refresh = refresh
+        self.frame = 0
+
+        lineHeight = self.font.get_linesize()
+        self.size = (
+            self.font.size(max(passes, key=len))[0] + 150,
+            lineHeight * (len(passes) + 4) + 8
+        )
+        w = 2 * self.size[0] / width
+        h = 2 * self.size[1] / height
+        self.quad = ScreenQuad(-1 + w/2, 1 - h/2, w, h)
+
+        self.texture = glGenTextures(1)
+        gl.bind_texture(0, GL_TEXTURE_2D, self.texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, *self.size, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+
+    def update(self, stats, calls):
+
+        # results lag a frame behind, nothing to show on the first one
+        if len(stats) == 0:
+            return
+        self.frame += 1
+        if self.frame % self.refresh != 1:
+            return
+
+        _, cpu, gpu = stats.rows(self.refresh)
+        rows = [("pass", "cpu ms", "gpu ms")]
+        for name, cpuTime, gpuTime in zip(
+            self.passes + ("frame",),
+            np.append(np.nanmean(cpu, axis=0), np.nansum(cpu, axis=1).mean()),
+            np.append(np.nanmean(gpu, axis=0), np.nansum(gpu, axis=1).mean())
+        ):
+            rows.append((name, f"{cpuTime:.2f}", f"{gpuTime:.2f}"))
+        rows.append(("gl calls", "issued", "skipped"))
+        rows.append(("", str(calls[0]), str(calls[1])))
+
+        surface = pg.Surface(self.size, pg.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        lineHeight = self.font.get_linesize()
+        for i, (name, cpuTime, gpuTime) in enumerate(rows):
+            y = 4 + i * lineHeight
+            surface.blit(self.font.render(name, True, (255, 255, 255)), (4, y))
+            # numbers are right aligned in two columns
+            for text, right in ((cpuTime, self.size[0] - 75),
+                                (gpuTime, self.size[0] - 4)):
+                label = self.font.render(text, True, (255, 255, 255))
+                surface.blit(label, (right - label.get_width(), y))
+
+        self.gl.bind_texture(0, GL_TEXTURE_2D, self.texture)
+        self.gl.active_texture(0)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, *self.size, GL_RGBA,
+                        GL_UNSIGNED_BYTE,
+                        pg.image.tostring(surface, "RGBA", True))
+
+    def draw(self):
+
+        gl = self.gl
+        gl.disable(GL_DEPTH_TEST)
+        gl.enable(GL_BLEND)
+        gl.set(glBlendFunc, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        gl.bind_texture(0, GL_TEXTURE_2D, self.texture)
+        gl.bind_vertex_array(self.quad.vao)
+        gl.call(glDrawArrays, GL_TRIANGLES, 0, 6)
+        gl.disable(GL_BLEND)
+        gl.enable(GL_DEPTH_TEST)
+
+    def destroy(self):
+        self.quad.destroy()
+        glDeleteTextures(1, (self.texture,))
+
 ###############################################################################
 
 
-myApp = App()
+# PyOpenGL checks glGetError after every call, for release speed run with
+# PYOPENGL_ERROR_CHECKING=0 (benchmark.py and batch_render.py do)
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--build-mesh-cache":
+        # eg. python deferred_shading.py --build-mesh-cache models
+        for filename in MeshCache().prebuild(sys.argv[2]):
+            print(filename)
+    else:
+        myApp = App()
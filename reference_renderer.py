@@ -0,0 +1,566 @@
+"""
+    CPU reference renderer of the deferred pipeline.
+
+    Rasterizes the scene's cubes into the same G-buffer the geometry pass
+    fills (world position and normal as half floats, diffuse + specular
+    as bytes) and evaluates the full screen lighting model of
+    l_fragment.txt over it, with vectorized NumPy and no OpenGL. The image
+    is split into tiles rendered by a pool of worker processes, which read
+    the scene's triangles from and write the result into shared memory.
+    Renders golden images and stills on machines without a GPU.
+
+    eg. python reference_renderer.py --cubes 200 --lights 10 --output ref.png
+"""
+import os
+# keeps stdout clean for the json report, spawned workers inherit it
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import json
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import pyrr
+
+from deferred_shading import (
+    Scene, ObjMesh, AssetLoader, create_model_transforms, pack_lights,
+    normalize, encode_png,
+    WIDTH, HEIGHT, CUBES_NUMBER, LIGHTS_NUMBER, MATERIAL_TEXTURE_SIZE
+)
+
+
+# pixels across a tile, the unit of work of a worker process
+REFERENCE_TILE_SIZE = 64
+# at most this many (triangle, pixel) candidates are tested at once
+REFERENCE_CHUNK = 1 << 18
+# the uniforms Engine draws with
+FIELD_OF_VIEW = 90
+NEAR_PLANE = 0.1
+FAR_PLANE = 40
+AMBIENT = np.array([0.1, 0.1, 0.1], dtype=np.float32)
+
+
+class SharedArrays:
+    """
+        numpy arrays in shared memory blocks. Other processes open the
+        same arrays from specs, a dict of picklable (block name, shape,
+        dtype), through attach().
+    """
+
+    def __init__(self, arrays):
+        """
+            arrays maps names to arrays to copy in, or (shape, dtype)
+            of ones to allocate.
+        """
+
+        self.blocks = []
+        self.arrays = {}
+        self.specs = {}
+        for name, array in arrays.items():
+            if isinstance(array, np.ndarray):
+                shape, dtype = array.shape, array.dtype
+            else:
+                shape, dtype = array[0], np.dtype(array[1])
+            # blocks can not be empty
+            block = shared_memory.SharedMemory(
+                create=True,
+                size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            self.blocks.append(block)
+            self.arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+            if isinstance(array, np.ndarray):
+                self.arrays[name][...] = array
+            self.specs[name] = (block.name, shape, dtype.str)
+
+    def close(self):
+        # the blocks can not be closed while arrays still point into them
+        self.arrays.clear()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+# blocks a worker process has open: spec -> (block, array)
+_attached = {}
+
+
+def attach(*specs):
+    """
+        Arrays of each SharedArrays.specs given, blocks of earlier specs
+        that are not among them any more get closed.
+    """
+
+    wanted = {spec for group in specs for spec in group.values()}
+    for spec in list(_attached):
+        if spec not in wanted:
+            block = _attached.pop(spec)[0]
+            block.close()
+
+    groups = []
+    for group in specs:
+        arrays = {}
+        for name, spec in group.items():
+            if spec not in _attached:
+                block = shared_memory.SharedMemory(name=spec[0])
+                _attached[spec] = (block, np.ndarray(
+                    spec[1], np.dtype(spec[2]), buffer=block.buf))
+            arrays[name] = _attached[spec][1]
+        groups.append(arrays)
+    return groups
+
+
+def camera_transforms(camera, width, height):
+    """
+        view and projection matrices (row vector convention), as Engine
+        builds them.
+    """
+
+    view = pyrr.matrix44.create_look_at(
+        eye=camera.position,
+        target=camera.position + camera.get_forwards(),
+        up=camera.get_up(),
+        dtype=np.float32
+    )
+    projection = pyrr.matrix44.create_perspective_projection(
+        fovy=FIELD_OF_VIEW, aspect=width/height,
+        near=NEAR_PLANE, far=FAR_PLANE, dtype=np.float32
+    )
+    return view, projection
+
+
+def clip_triangles(triangles, distances):
+    """
+        Cut (T,3,F) triangles, whose vertices start with their clip space
+        position, to the side of a plane where the (T,3) vertex distances
+        are positive. Every vertex attribute is linear in clip space, so
+        new vertices interpolate them all. Winding is kept.
+    """
+
+    inside = distances >= 0
+    counts = inside.sum(axis=1)
+    pieces = [triangles[counts == 3]]
+    corners = np.arange(3)
+
+    def intersect(a, b, da, db):
+        t = (da / (da - db))[:, np.newaxis]
+        return a + (b - a) * t
+
+    # one vertex in: it stays, its two edges are cut
+    one = counts == 1
+    first = np.argmax(inside[one], axis=1)[:, np.newaxis]
+    order = (first + corners) % 3
+    v = np.take_along_axis(triangles[one], order[:, :, np.newaxis], axis=1)
+    d = np.take_along_axis(distances[one], order, axis=1)
+    pieces.append(np.stack((
+        v[:, 0],
+        intersect(v[:, 0], v[:, 1], d[:, 0], d[:, 1]),
+        intersect(v[:, 0], v[:, 2], d[:, 0], d[:, 2])
+    ), axis=1))
+
+    # two vertices in: the quad left over becomes two triangles
+    two = counts == 2
+    outside = np.argmin(inside[two], axis=1)[:, np.newaxis]
+    order = (outside + 1 + corners) % 3
+    v = np.take_along_axis(triangles[two], order[:, :, np.newaxis], axis=1)
+    d = np.take_along_axis(distances[two], order, axis=1)
+    bc = intersect(v[:, 1], v[:, 2], d[:, 1], d[:, 2])
+    ac = intersect(v[:, 0], v[:, 2], d[:, 0], d[:, 2])
+    pieces.append(np.stack((v[:, 0], v[:, 1], bc), axis=1))
+    pieces.append(np.stack((v[:, 0], bc, ac), axis=1))
+
+    return np.concatenate(pieces)
+
+
+def load_materials(materials):
+    """
+        Diffuse texels (M,S,S,4) uint8, bottom row first, and specular
+        values of the materials, as MaterialArray and the asset loader
+        fill them: 1x1 colors, or every layer is an image's size when
+        one is.
+    """
+
+    size = 1
+    if any(isinstance(color, str) for color, _ in materials):
+        size = MATERIAL_TEXTURE_SIZE
+    diffuse = np.zeros((len(materials), size, size, 4), dtype=np.uint8)
+    specular = np.zeros(len(materials), dtype=np.float32)
+    for i, (color, shininess) in enumerate(materials):
+        if isinstance(color, str):
+            diffuse[i] = AssetLoader.decode_texture(color, size)[0]
+        else:
+            diffuse[i, ..., 0:3] = np.round(255 * np.asarray(color))
+        specular[i] = round(255 * shininess) / 255
+
+    return diffuse, specular
+
+
+def scene_arrays(scene, width, height):
+    """
+        What the tiles are rendered from: the scene's triangles in
+        screen space, clipped to the near and far planes and back face
+        culled, plus the materials, lights and camera position.
+    """
+
+    view, projection = camera_transforms(scene.camera, width, height)
+    cubes = scene.cubes
+    models = create_model_transforms(
+        cubes.positions, cubes.eulers,
+        out=np.empty((len(cubes), 4, 4), dtype=np.float32))
+
+    # per vertex: clip position 4, world position 3, normal 3, uv 2 and
+    # the material, interpolating it leaves it unchanged
+    triangles = []
+    for meshId, filename in enumerate(scene.meshes):
+        instances = np.flatnonzero(cubes.meshIds == meshId)
+        if len(instances) == 0:
+            continue
+        vertices, indices = ObjMesh.loadMesh(filename)
+        corners = vertices[indices].reshape(-1, 3, 14)
+        position = np.concatenate(
+            (corners[..., 0:3], np.ones(corners.shape[:2] + (1,))), axis=-1)
+
+        world = np.einsum("tvi,cij->ctvj", position, models[instances])
+        normal = np.einsum("tvi,cij->ctvj", corners[..., 5:8],
+                           models[instances, 0:3, 0:3])
+        data = np.empty(world.shape[:3] + (13,))
+        data[..., 0:4] = world @ (view @ projection)
+        data[..., 4:7] = world[..., 0:3]
+        data[..., 7:10] = normalize(normal.reshape(-1, 3)).reshape(
+            normal.shape)
+        data[..., 10:12] = corners[..., 3:5]
+        data[..., 12] = cubes.materialIds[instances, np.newaxis, np.newaxis]
+        triangles.append(data.reshape(-1, 3, 13))
+    triangles = np.concatenate(triangles) if triangles \
+        else np.zeros((0, 3, 13))
+
+    # near (z > -w) and far (z < w) planes, the sides are left to the
+    # bounding boxes
+    triangles = clip_triangles(triangles,
+                               triangles[..., 2] + triangles[..., 3])
+    triangles = clip_triangles(triangles,
+                               triangles[..., 3] - triangles[..., 2])
+
+    w = triangles[..., 3]
+    x = (triangles[..., 0] / w * 0.5 + 0.5) * width
+    y = (triangles[..., 1] / w * 0.5 + 0.5) * height
+    z = triangles[..., 2] / w
+
+    # counter clockwise is the front face, culled like the geometry pass
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) \
+        - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    # pixels whose centre the triangle's bounding box holds
+    bounds = np.stack((
+        np.maximum(np.ceil(x.min(axis=1) - 0.5), 0),
+        np.minimum(np.floor(x.max(axis=1) - 0.5), width - 1),
+        np.maximum(np.ceil(y.min(axis=1) - 0.5), 0),
+        np.minimum(np.floor(y.max(axis=1) - 0.5), height - 1)
+    ), axis=1)
+    keep = (area > 0) & (bounds[:, 0] <= bounds[:, 1]) \
+        & (bounds[:, 2] <= bounds[:, 3])
+    triangles, x, y, z, area = \
+        triangles[keep], x[keep], y[keep], z[keep], area[keep]
+
+    # barycentric weight i = edges[:, i] . (x, y, 1), from the edge
+    # opposite vertex i
+    a, b = [1, 2, 0], [2, 0, 1]
+    edges = np.stack((
+        -(y[:, b] - y[:, a]),
+        x[:, b] - x[:, a],
+        (y[:, b] - y[:, a]) * x[:, a] - (x[:, b] - x[:, a]) * y[:, a]
+    ), axis=-1) / area[:, np.newaxis, np.newaxis]
+
+    diffuse, specular = load_materials(scene.materials)
+    lights = np.zeros((len(scene.lights), 2, 4), dtype=np.float32)
+    pack_lights(scene.lights, lights)
+
+    return {
+        "bounds": bounds[keep].astype(np.int32),
+        "edges": edges,
+        "depth": z,
+        "inverseW": 1 / triangles[..., 3],
+        "position": triangles[..., 4:7].astype(np.float32),
+        "normal": triangles[..., 7:10].astype(np.float32),
+        "texCoord": triangles[..., 10:12].astype(np.float32),
+        "material": triangles[:, 0, 12].astype(np.int32),
+        "diffuse": diffuse,
+        "specular": specular,
+        "lights": lights,
+        "camera": np.asarray(scene.camera.position, dtype=np.float32)
+    }
+
+
+def sample_texture(texels, layers, texCoords):
+    """
+        Bilinear, repeating lookup of (N,) layers at (N,2) texture
+        coordinates into (M,S,S,4) uint8 texels, as 0-1 floats. There
+        are no mip levels, minified images come out sharper than on the
+        GPU.
+    """
+
+    size = texels.shape[1]
+    if size == 1:
+        return texels[layers, 0, 0] / np.float32(255)
+
+    position = texCoords * size - 0.5
+    origin = np.floor(position)
+    fraction = (position - origin)[..., np.newaxis]
+    x0, y0 = (origin.astype(np.int64) % size).T
+    x1, y1 = (x0 + 1) % size, (y0 + 1) % size
+    bottom = texels[layers, y0, x0] * (1 - fraction[:, 0]) \
+        + texels[layers, y0, x1] * fraction[:, 0]
+    top = texels[layers, y1, x0] * (1 - fraction[:, 0]) \
+        + texels[layers, y1, x1] * fraction[:, 0]
+    return ((bottom * (1 - fraction[:, 1]) + top * fraction[:, 1])
+            / 255).astype(np.float32)
+
+
+def rasterize_tile(scene, tile):
+    """
+        Depth tested nearest triangle and barycentric weights of every
+        pixel centre of tile (x0, y0, x1, y1), triangle -1 where none.
+    """
+
+    x0, y0, x1, y1 = tile
+    tileWidth = x1 - x0
+    bounds = scene["bounds"]
+    # candidates: triangles whose bounding box reaches into the tile
+    candidates = np.flatnonzero(
+        (bounds[:, 0] < x1) & (bounds[:, 1] >= x0)
+        & (bounds[:, 2] < y1) & (bounds[:, 3] >= y0))
+    left = np.maximum(bounds[candidates, 0], x0)
+    bottom = np.maximum(bounds[candidates, 2], y0)
+    widths = np.minimum(bounds[candidates, 1] + 1, x1) - left
+    counts = widths * (np.minimum(bounds[candidates, 3] + 1, y1) - bottom)
+
+    pixels = tileWidth * (y1 - y0)
+    nearest = np.ones(pixels)
+    triangle = np.full(pixels, -1)
+    weights = np.zeros((pixels, 3))
+
+    # chunks of whole triangles with about REFERENCE_CHUNK pixels in all
+    ends = np.cumsum(counts)
+    splits = np.searchsorted(
+        ends, np.arange(REFERENCE_CHUNK, ends[-1] if len(ends) else 0,
+                        REFERENCE_CHUNK), side="right")
+    for chunk in np.split(np.arange(len(candidates)), splits):
+        if len(chunk) == 0:
+            continue
+        # one entry per (triangle, pixel in its bounding box)
+        owner = np.repeat(chunk, counts[chunk])
+        starts = np.repeat(np.cumsum(counts[chunk]) - counts[chunk],
+                           counts[chunk])
+        offset = np.arange(len(owner)) - starts
+        x = left[owner] + offset % widths[owner]
+        y = bottom[owner] + offset // widths[owner]
+        ids = candidates[owner]
+
+        edges = scene["edges"][ids]
+        b = edges[..., 0] * (x + 0.5)[:, np.newaxis] \
+            + edges[..., 1] * (y + 0.5)[:, np.newaxis] + edges[..., 2]
+        inside = np.all(b >= 0, axis=1)
+        b, ids = b[inside], ids[inside]
+        pixel = (y[inside] - y0) * tileWidth + x[inside] - x0
+        depth = np.einsum("nv,nv->n", b, scene["depth"][ids]) * 0.5 + 0.5
+
+        # nearest per pixel, ties keep the earlier triangle (GL_LESS)
+        order = np.lexsort((depth, pixel))
+        pixel, depth, b, ids = pixel[order], depth[order], b[order], \
+            ids[order]
+        first = np.ones(len(pixel), dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+        closer = first & (depth < nearest[pixel])
+        pixel = pixel[closer]
+        nearest[pixel] = depth[closer]
+        triangle[pixel] = ids[closer]
+        weights[pixel] = b[closer]
+
+    return nearest, triangle, weights
+
+
+def shade_tile(scene, output, tile):
+    """
+        Geometry pass then lighting pass of tile (x0, y0, x1, y1), into
+        output's color, depth and G-buffer arrays.
+    """
+
+    x0, y0, x1, y1 = tile
+    shape = (y1 - y0, x1 - x0)
+    nearest, triangle, weights = rasterize_tile(scene, tile)
+    covered = np.flatnonzero(triangle >= 0)
+    ids = triangle[covered]
+
+    # perspective correct interpolation
+    weights = weights[covered] * scene["inverseW"][ids]
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    def interpolate(name):
+        return np.einsum("nv,nvc->nc", weights, scene[name][ids])
+
+    # geometry pass, stored at the G-buffer's precision
+    gPosition = np.zeros(shape + (3,), dtype=np.float16)
+    gNormal = np.zeros(shape + (3,), dtype=np.float16)
+    gDiffuseSpecular = np.zeros(shape + (4,), dtype=np.uint8)
+    materials = scene["material"][ids]
+    diffuse = sample_texture(scene["diffuse"], materials,
+                             interpolate("texCoord"))
+    gPosition.reshape(-1, 3)[covered] = interpolate("position")
+    gNormal.reshape(-1, 3)[covered] = normalize(interpolate("normal"))
+    gDiffuseSpecular.reshape(-1, 4)[covered, 0:3] = np.round(
+        255 * diffuse[:, 0:3])
+    gDiffuseSpecular.reshape(-1, 4)[covered, 3] = np.round(
+        255 * scene["specular"][materials])
+
+    # lighting pass, what l_fragment.txt does for every light
+    position = gPosition.reshape(-1, 3)[covered].astype(np.float32)
+    normal = normalize(gNormal.reshape(-1, 3)[covered].astype(np.float32))
+    diffuseSpecular = gDiffuseSpecular.reshape(-1, 4)[covered] \
+        / np.float32(255)
+    viewDirection = normalize(scene["camera"] - position)
+    light = AMBIENT * diffuseSpecular[:, 0:3]
+    if len(covered):
+        low, high = position.min(axis=0), position.max(axis=0)
+    lights = scene["lights"]
+    for lightPosition, strength, color, radius in zip(
+            lights[:, 0, 0:3], lights[:, 0, 3],
+            lights[:, 1, 0:3], lights[:, 1, 3]):
+        # attenuation is zero from the radius on
+        if len(covered) == 0 or np.linalg.norm(
+                lightPosition - np.clip(lightPosition, low, high)) >= radius:
+            continue
+        toLight = lightPosition - position
+        distance = np.linalg.norm(toLight, axis=1)
+        lightDirection = toLight / distance[:, np.newaxis]
+        halfDirection = normalize(lightDirection + viewDirection)
+        lambert = np.maximum(np.einsum("nc,nc->n", normal, lightDirection), 0)
+        highlight = np.maximum(
+            np.einsum("nc,nc->n", normal, halfDirection), 0) ** 32
+        window = np.clip(1 - (distance / radius) ** 4, 0, 1)
+        attenuation = window * window / distance
+        light += (color * lambert[:, np.newaxis] * diffuseSpecular[:, 0:3]
+                  + color * strength * (highlight * diffuseSpecular[:, 3])
+                  [:, np.newaxis]) * attenuation[:, np.newaxis]
+
+    # the lighting target is RGBA8, the background stays black
+    color = np.zeros(shape + (4,), dtype=np.uint8)
+    color[..., 3] = 255
+    color.reshape(-1, 4)[covered, 0:3] = np.round(
+        255 * np.clip(light, 0, 1))
+
+    region = (slice(y0, y1), slice(x0, x1))
+    output["color"][region] = color
+    output["depth"][region] = nearest.reshape(shape)
+    output["position"][region] = gPosition
+    output["normal"][region] = gNormal
+    output["diffuseSpecular"][region] = gDiffuseSpecular
+
+
+def render_tile(inputSpecs, outputSpecs, tile):
+    """
+        Worker process side of shade_tile, on shared arrays.
+    """
+    shade_tile(*attach(inputSpecs, outputSpecs), tile)
+
+
+class ReferenceRenderer:
+    """
+        Renders scenes at a fixed size on a pool of worker processes
+        (inline for workers <= 1), which stays up between renders.
+    """
+
+    def __init__(self, width=WIDTH, height=HEIGHT, workers=None,
+                 tileSize=REFERENCE_TILE_SIZE):
+
+        self.width = width
+        self.height = height
+        self.tiles = [
+            (x, y, min(x + tileSize, width), min(y + tileSize, height))
+            for y in range(0, height, tileSize)
+            for x in range(0, width, tileSize)
+        ]
+        # rows are bottom first, like glReadPixels
+        self.output = SharedArrays({
+            "color": ((height, width, 4), np.uint8),
+            "depth": ((height, width), np.float32),
+            "position": ((height, width, 3), np.float16),
+            "normal": ((height, width, 3), np.float16),
+            "diffuseSpecular": ((height, width, 4), np.uint8)
+        })
+        self.workers = os.cpu_count() if workers is None else workers
+        self.pool = None
+        if self.workers > 1:
+            # forking a process that runs threads (GL drivers, the asset
+            # loader) can copy a held lock into the workers
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                self.workers)
+
+    def render(self, scene):
+        """
+            color, depth and G-buffer arrays of the scene seen from its
+            camera.
+        """
+
+        scene = scene_arrays(scene, self.width, self.height)
+        if self.pool is None:
+            for tile in self.tiles:
+                shade_tile(scene, self.output.arrays, tile)
+        else:
+            shared = SharedArrays(scene)
+            try:
+                tasks = [(shared.specs, self.output.specs, tile)
+                         for tile in self.tiles]
+                self.pool.starmap(render_tile, tasks, chunksize=1)
+            finally:
+                shared.close()
+
+        return {name: array.copy()
+                for name, array in self.output.arrays.items()}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.output.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cubes", type=int, default=CUBES_NUMBER)
+    parser.add_argument("--lights", type=int, default=LIGHTS_NUMBER)
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--height", type=int, default=HEIGHT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int,
+                        help="processes, the number of cores by default")
+    parser.add_argument("--tile", type=int, default=REFERENCE_TILE_SIZE)
+    parser.add_argument("--output", default="reference.png",
+                        help="png the lit image is written to")
+    args = parser.parse_args()
+
+    scene = Scene(cubeCount=args.cubes, lightCount=args.lights,
+                  seed=args.seed)
+    renderer = ReferenceRenderer(args.width, args.height, args.workers,
+                                 args.tile)
+    # the shared memory blocks must not outlive a failed render
+    try:
+        start = time.perf_counter()
+        image = renderer.render(scene)["color"]
+        elapsed = time.perf_counter() - start
+    finally:
+        renderer.close()
+
+    with open(args.output, "wb") as f:
+        f.write(encode_png(image[::-1]))
+    print(json.dumps({
+        "output": args.output,
+        "width": args.width,
+        "height": args.height,
+        "workers": renderer.workers,
+        "tiles": len(renderer.tiles),
+        "seconds": elapsed
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()